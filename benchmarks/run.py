@@ -0,0 +1,272 @@
+import argparse
+import glob
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from unittest import mock
+
+import numpy as np
+
+from benchmarks.stand_ins import (FakeNovaPoshtaHandler, FakeOpenAIHandler, ephemeral_chroma_client, fake_redis_class,
+                                  local_redis_class, start_server)
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+TRACKING_NUMBERS = ["20450761462654", "20450761462655", "59000912345678"]
+# A single startup measurement is too noisy to fail a run on
+MIN_GATED_SAMPLES = 5
+
+
+class StageTimer:
+    def __init__(self):
+        self.durations = defaultdict(list)
+
+    @contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[stage].append(time.perf_counter() - start)
+
+    def summary(self):
+        return {stage: {
+            "count": len(durations),
+            "mean_ms": float(np.mean(durations) * 1000),
+            "p50_ms": float(np.percentile(durations, 50) * 1000),
+            "p95_ms": float(np.percentile(durations, 95) * 1000),
+            "p99_ms": float(np.percentile(durations, 99) * 1000),
+        } for stage, durations in self.durations.items()}
+
+
+def count_cache_hits(cache, counter):
+    get = cache.get
+
+    def counted_get(prompt):
+        completion = get(prompt)
+        counter["hits" if completion else "misses"] += 1
+        return completion
+    cache.get = counted_get
+
+
+def hit_ratio(counter):
+    total = counter["hits"] + counter["misses"]
+    return counter["hits"] / total if total else 0.0
+
+
+def load_questions(knowledge_base_dir):
+    questions = []
+    for filepath in sorted(glob.glob(os.path.join(knowledge_base_dir, "info", "faq_*.txt"))):
+        with open(filepath, encoding="utf-8") as fp:
+            first_line = next((line.strip() for line in fp if line.strip()), "")
+        if first_line:
+            questions.append(first_line)
+    return questions
+
+
+def sample_messages(questions, n, rng):
+    # Skewed towards the first questions, like real FAQ traffic, with some tracking requests mixed in
+    weights = 1 / np.arange(1, len(questions) + 1)
+    messages = rng.choices(questions, weights=weights, k=n)
+    return [f"Де моя посилка {rng.choice(TRACKING_NUMBERS)}?" if rng.random() < 0.2 else message
+            for message in messages]
+
+
+@contextmanager
+def stand_ins(args):
+    with ExitStack() as stack:
+        FakeOpenAIHandler.chat_latency = args.llm_latency / 1000
+        FakeOpenAIHandler.embedding_latency = args.embedding_latency / 1000
+        FakeOpenAIHandler.requests_per_minute = args.llm_rpm_limit
+        FakeNovaPoshtaHandler.latency = args.api_latency / 1000
+        openai_server, openai_url = start_server(FakeOpenAIHandler)
+        nova_poshta_server, nova_poshta_url = start_server(FakeNovaPoshtaHandler)
+        stack.callback(openai_server.shutdown)
+        stack.callback(nova_poshta_server.shutdown)
+        stack.enter_context(mock.patch.dict(os.environ, {
+            "OPENAI_API_KEY": "bench", "OPENAI_API_BASE": f"{openai_url}/v1", "NOVA_POST_API_KEY": "bench",
+            **({"LLM_REQUESTS_PER_MINUTE": str(args.scheduler_rpm)} if args.scheduler_rpm else {})}))
+
+        import chromadb
+        import redis
+
+        stack.enter_context(mock.patch.object(chromadb, "HttpClient", ephemeral_chroma_client))
+        if args.redis_url:
+            redis.Redis.from_url(args.redis_url).flushall()
+            stack.enter_context(mock.patch.object(redis, "Redis", local_redis_class(args.redis_url)))
+        else:
+            stack.enter_context(mock.patch.object(redis, "Redis", fake_redis_class()))
+
+        from core.city_index import city_index_loader
+        from core.novaposhta_client import np_client
+
+        index_dir = stack.enter_context(tempfile.TemporaryDirectory())
+        stack.enter_context(mock.patch.object(np_client, "url", nova_poshta_url))
+        stack.enter_context(mock.patch.object(city_index_loader, "path", os.path.join(index_dir, "settlements.json")))
+        yield
+
+
+def bench_startup(timer):
+    from core import agent as core_agent
+
+    with timer.measure("startup.init_chromadb"):
+        cached_embedder, chroma_emb_client = core_agent.init_chromadb()
+    with timer.measure("startup.init_content_embeddings"):
+        context_retriever = core_agent.init_content_embeddings(cached_embedder, chroma_emb_client)
+    with timer.measure("startup.init_qna_retrieval"):
+        cached_conversational_rqa, llm = core_agent.init_qna_retrieval(context_retriever, cached_embedder, chroma_emb_client)
+    tool_cache = core_agent.init_tool_cache()
+    with timer.measure("startup.init_agent"):
+        agent = core_agent.init_agent(cached_conversational_rqa, llm, tool_cache)
+    with timer.measure("startup.init_router"):
+        router = core_agent.init_router(cached_conversational_rqa, tool_cache)
+    return context_retriever, cached_conversational_rqa, agent, router
+
+
+def bench_retrieval(context_retriever, questions, timer):
+    for question in questions:
+        with timer.measure("retrieval"):
+            context_retriever.get_relevant_documents(question)
+
+
+def bench_rqa(cached_conversational_rqa, questions, timer, cache_counter):
+    count_cache_hits(cached_conversational_rqa.cache, cache_counter)
+    for stage in ("rqa.cold", "rqa.warm"):
+        for question in questions:
+            with timer.measure(stage):
+                cached_conversational_rqa(question, [])
+
+
+def bench_tools(timer, tool_counter, repeats=5):
+    import redis
+    from core.tool_cache import ToolResponseCache
+    from core.tool_functions import (Package, DeliveryCost, DeliveryDetails, get_package_info,
+                                     calculate_delivery_cost, estimate_delivery_date)
+
+    tool_cache = ToolResponseCache(redis.Redis(db=4))
+    calls = [
+        ("get_package_info", tool_cache.wrap(get_package_info, Package), (TRACKING_NUMBERS[0],), {}),
+        ("calculate_delivery_cost", tool_cache.wrap(calculate_delivery_cost, DeliveryCost), (), dict(
+            city_sender="Київ", city_recipient="Львів", weight=2, cost=500, cargo_type="Cargo",
+            width=20, length=30, height=10)),
+        ("estimate_delivery_date", tool_cache.wrap(estimate_delivery_date, DeliveryDetails), (), dict(
+            date="18.10.2026", city_sender="Одеса", city_recipient="Київ")),
+    ]
+    for _ in range(repeats):
+        for tool_name, func, args, kwargs in calls:
+            with timer.measure(f"tool.{tool_name}"):
+                func(*args, **kwargs)
+    for tool_name, stats in tool_cache.stats.items():
+        tool_counter[tool_name] = stats
+
+
+def bench_chat(agent, router, questions, timer, sessions, messages_per_session, seed):
+    from langchain.memory import ChatMessageHistory
+    from core.llm_wrapers import LLMChatHandler
+
+    def run_session(session_index):
+        rng = random.Random(seed + session_index)
+        chat_handler = LLMChatHandler(agent, ChatMessageHistory(), router=router)
+        for message in sample_messages(questions, messages_per_session, rng):
+            with timer.measure("chat.send_message"):
+                chat_handler.send_message(message)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=sessions) as executor:
+        list(executor.map(run_session, range(sessions)))
+    elapsed = time.perf_counter() - start
+    return sessions * messages_per_session / elapsed
+
+
+def find_regressions(report, baseline, tolerance, min_delta_ms):
+    regressions = []
+    for stage, stats in baseline.get("stages", {}).items():
+        current = report["stages"].get(stage)
+        if not current or min(current["count"], stats["count"]) < MIN_GATED_SAMPLES:
+            continue
+        # The tail of the concurrent stages depends on how the sessions interleave, the median does not
+        if current["p50_ms"] > max(stats["p50_ms"] * (1 + tolerance), stats["p50_ms"] + min_delta_ms):
+            regressions.append(f"{stage}: p50 {current['p50_ms']:.1f} ms > baseline {stats['p50_ms']:.1f} ms")
+    for name, value in baseline.get("throughput", {}).items():
+        current = report["throughput"].get(name)
+        if current is not None and current < value * (1 - tolerance):
+            regressions.append(f"{name}: {current:.2f} msg/s < baseline {value:.2f} msg/s")
+    return regressions
+
+
+def print_report(report):
+    print(f"{'stage':<36}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, stats in sorted(report["stages"].items()):
+        print(f"{stage:<36}{stats['count']:>7}{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}")
+    for name, value in report["throughput"].items():
+        print(f"{name}: {value:.2f} msg/s")
+    print(f"LLM requests rejected with 429: {report['llm_rate_limited']}")
+    for name, value in report["cache_hit_ratio"].items():
+        print(f"{name} hit ratio: {value:.2%}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the chat path against local stand-ins")
+    parser.add_argument("--sessions", type=int, default=8)
+    parser.add_argument("--messages", type=int, default=40, help="messages per session")
+    parser.add_argument("--llm-latency", type=float, default=50, help="fake chat completion latency, ms")
+    parser.add_argument("--embedding-latency", type=float, default=10, help="fake embedding latency, ms")
+    parser.add_argument("--api-latency", type=float, default=30, help="fake Nova Poshta API latency, ms")
+    parser.add_argument("--llm-rpm-limit", type=int, help="fake OpenAI answers 429 above this requests per minute")
+    parser.add_argument("--scheduler-rpm", type=int, help="requests per minute budget of the LLM scheduler")
+    parser.add_argument("--redis-url", help="use a local Redis instead of fakeredis, it gets flushed")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+    parser.add_argument("--min-delta", type=float, default=10, help="allowed absolute p50 regression, ms")
+    parser.add_argument("--output", help="write the JSON report to this path")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    timer = StageTimer()
+    rqa_cache_counter = defaultdict(int)
+    tool_counter = {}
+    with stand_ins(args):
+        context_retriever, cached_conversational_rqa, agent, router = bench_startup(timer)
+        questions = load_questions("./knowledge_base")
+        bench_retrieval(context_retriever, questions, timer)
+        bench_rqa(cached_conversational_rqa, questions, timer, rqa_cache_counter)
+        bench_tools(timer, tool_counter)
+        throughput = bench_chat(agent, router, questions, timer, args.sessions, args.messages, args.seed)
+
+    report = {
+        "stages": timer.summary(),
+        "throughput": {f"chat.{args.sessions}_sessions": throughput},
+        "llm_rate_limited": FakeOpenAIHandler.rate_limited,
+        "cache_hit_ratio": {"completion_cache": hit_ratio(rqa_cache_counter),
+                            **{f"tool.{name}": hit_ratio(stats) for name, stats in tool_counter.items()}},
+    }
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as fp:
+            json.dump(report, fp, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline to compare with, run with --save-baseline to create one")
+        return 0
+    with open(args.baseline) as fp:
+        regressions = find_regressions(report, json.load(fp), args.tolerance, args.min_delta)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
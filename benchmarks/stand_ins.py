@@ -0,0 +1,205 @@
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+EMBEDDING_DIM = 1536
+TRACKING_NUMBER = re.compile(r"\b\d{14}\b")
+
+
+def fake_embedding(text):
+    # Hashed bag of words, so texts sharing words get similar vectors like real embeddings do
+    vector = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+    for word in re.findall(r"\w+", text.lower()):
+        index = int.from_bytes(hashlib.md5(word.encode()).digest()[:4], "little")
+        vector[index % EMBEDDING_DIM] += 1.0
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector + 1 / np.sqrt(EMBEDDING_DIM)).tolist()
+
+
+class JSONHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def read_json(self):
+        return json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeOpenAIHandler(JSONHandler):
+    chat_latency = 0.05
+    embedding_latency = 0.01
+    # Like the real API: requests over the per-minute limit get a 429
+    requests_per_minute = None
+    rate_limited = 0
+    request_times = []
+    rate_lock = threading.Lock()
+
+    def over_rate_limit(self):
+        if not self.requests_per_minute:
+            return False
+        cls = type(self)
+        with cls.rate_lock:
+            now = time.monotonic()
+            cls.request_times = [t for t in cls.request_times if now - t < 60] + [now]
+            if len(cls.request_times) <= self.requests_per_minute:
+                return False
+            cls.request_times.pop()
+            cls.rate_limited += 1
+            return True
+
+    def do_POST(self):
+        request_json = self.read_json()
+        if self.path.endswith("/chat/completions") and self.over_rate_limit():
+            self.send_json({"error": {"message": "Rate limit reached for requests", "type": "requests",
+                                      "code": "rate_limit_exceeded"}}, status=429)
+            return
+        if self.path.endswith("/embeddings"):
+            time.sleep(self.embedding_latency)
+            inputs = request_json["input"]
+            inputs = [inputs] if isinstance(inputs, (str, int)) or (inputs and isinstance(inputs[0], int)) else inputs
+            self.send_json({
+                "object": "list",
+                "data": [{"object": "embedding", "index": i, "embedding": fake_embedding(str(text))}
+                         for i, text in enumerate(inputs)],
+                "model": request_json.get("model"),
+                "usage": {"prompt_tokens": 0, "total_tokens": 0},
+            })
+        elif self.path.endswith("/chat/completions"):
+            time.sleep(self.chat_latency)
+            message = self.completion_message(request_json)
+            if request_json.get("stream"):
+                self.send_stream(request_json, message)
+            else:
+                self.send_json({
+                    "id": uuid.uuid4().hex, "object": "chat.completion", "created": int(time.time()),
+                    "model": request_json.get("model"),
+                    "choices": [{"index": 0, "message": message,
+                                 "finish_reason": "function_call" if "function_call" in message else "stop"}],
+                    "usage": {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120},
+                })
+        else:
+            self.send_json({"error": {"message": "Not found"}}, status=404)
+
+    @staticmethod
+    def completion_message(request_json):
+        messages = request_json["messages"]
+        user_input = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "") or ""
+        called_function = any(m["role"] == "function" for m in messages)
+        functions = {function["name"] for function in request_json.get("functions", [])}
+
+        if functions and not called_function:
+            tracking_number = TRACKING_NUMBER.search(user_input)
+            if tracking_number:
+                action = ("package_info", {"tracking_number": tracking_number.group()})
+            else:
+                action = ("question_answering", {"question": user_input})
+            if "tool_selection" in functions:
+                arguments = {"actions": [{"action_name": action[0], "action": action[1]}]}
+                return {"role": "assistant", "content": None, "function_call": {
+                    "name": "tool_selection", "arguments": json.dumps(arguments, ensure_ascii=False)}}
+            if action[0] in functions:
+                return {"role": "assistant", "content": None, "function_call": {
+                    "name": action[0], "arguments": json.dumps(action[1], ensure_ascii=False)}}
+        return {"role": "assistant", "content": "Відповідь згідно з контекстом: зверніться до відділення Нової Пошти."}
+
+    def send_stream(self, request_json, message):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        if "function_call" in message:
+            deltas = [{"role": "assistant", "content": None, "function_call": message["function_call"]}]
+        else:
+            deltas = [{"role": "assistant", "content": ""}] + [{"content": word + " "}
+                                                               for word in message["content"].split()]
+        for delta in deltas:
+            chunk = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": request_json.get("model"),
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+        self.wfile.write(b"data: [DONE]\n\n")
+
+
+class FakeNovaPoshtaHandler(JSONHandler):
+    latency = 0.03
+    settlements = [
+        {"Description": "Київ", "Ref": "8d5a980d-391c-11dd-90d9-001a92567626", "SettlementTypeDescription": "місто"},
+        {"Description": "Львів", "Ref": "db5c88f5-391c-11dd-90d9-001a92567626", "SettlementTypeDescription": "місто"},
+        {"Description": "Одеса", "Ref": "db5c88d0-391c-11dd-90d9-001a92567626", "SettlementTypeDescription": "місто"},
+    ]
+
+    def do_POST(self):
+        time.sleep(self.latency)
+        request_json = self.read_json()
+        called_method = request_json.get("calledMethod")
+        properties = request_json.get("methodProperties", {})
+        if called_method == "getStatusDocuments":
+            data = [{"Status": "Відправлення у місті Київ", "DateCreated": "18-10-2026 10:00:00",
+                     "DocumentWeight": 1, "DocumentCost": 70, "ScheduledDeliveryDate": "20-10-2026 12:00:00"}]
+        elif called_method == "getSettlements":
+            data = self.settlements if properties.get("Page", "1") == "1" else []
+        elif called_method == "searchSettlements":
+            data = [{"Addresses": [{"Ref": self.settlements[0]["Ref"]}]}]
+        elif called_method == "getDocumentPrice":
+            data = [{"Cost": 70}]
+        elif called_method == "getDocumentDeliveryDate":
+            data = [{"DeliveryDate": {"date": "2026-10-20 00:00:00", "timezone": "Europe/Kyiv"}}]
+        else:
+            data = []
+        self.send_json({"success": True, "data": data, "errors": []})
+
+
+def start_server(handler_class):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def fake_redis_class():
+    import fakeredis
+
+    server = fakeredis.FakeServer()
+
+    # A subclass rather than a factory function, redis.Redis is also used in isinstance checks (RedisStore)
+    class BenchRedis(fakeredis.FakeRedis):
+        def __init__(self, host=None, port=None, db=0, **kwargs):
+            super().__init__(server=server, db=db)
+    return BenchRedis
+
+
+def local_redis_class(url):
+    import redis
+
+    class BenchRedis(redis.Redis):
+        def __init__(self, host=None, port=None, db=0, **kwargs):
+            super().__init__(connection_pool=redis.ConnectionPool.from_url(url, db=db, **kwargs))
+    return BenchRedis
+
+
+def ephemeral_chroma_client(**kwargs):
+    import chromadb
+    from chromadb.config import Settings
+
+    client = chromadb.EphemeralClient(Settings(anonymized_telemetry=False))
+    # init_chromadb marks the client settings as persistent, which the in-memory segments must not see
+    client._settings = client._settings.copy()
+    return client
@@ -1,91 +1,147 @@
-import glob
-import hashlib
-import inspect
+import functools
 import os
+import re
 
 import chromadb
-import langchain
-from langchain.agents import Tool, initialize_agent, AgentType
-from langchain.callbacks import get_openai_callback
-from langchain.chains import LLMChain, RetrievalQA, create_tagging_chain_pydantic
-from langchain.chat_models import ChatOpenAI
-from langchain.document_loaders import TextLoader
+from langchain.agents import Tool
+from langchain.agents.openai_functions_multi_agent.base import OpenAIMultiFunctionsAgent
+from langchain.chains import LLMChain, RetrievalQA
 from langchain.embeddings import OpenAIEmbeddings
-from langchain.llms import OpenAI
-from langchain.memory import RedisChatMessageHistory, ConversationBufferWindowMemory
 from langchain.retrievers.merger_retriever import MergerRetriever
-from langchain.prompts import PromptTemplate, ChatPromptTemplate, MessagesPlaceholder
+from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain.prompts.chat import SystemMessagePromptTemplate, HumanMessagePromptTemplate
-from langchain.retrievers import BM25Retriever, EnsembleRetriever
-from langchain.storage import LocalFileStore, RedisStore
+from langchain.storage import RedisStore
 from langchain.tools import StructuredTool
 from langchain.vectorstores import Chroma
 import redis
-import spacy
 
+from core.chat_history import BoundedRedisChatMessageHistory
+from core.context_assembler import ContextAssemblyRetriever
+from core.bm25_index import get_lemmatizer, load_bm25_retriever
+from core.hybrid_retriever import HybridRetriever
+from core.llm_scheduler import PRIORITY_BACKGROUND, LLMScheduler, ScheduledChatOpenAI
 from core.llm_wrapers import *
+from core.router import IntentRouter
+from core.tool_cache import ToolResponseCache
 from core.tool_functions import *
 from core.utils import *
-import hashlib
 
 
 REDIS_HOST = "redis"
 CHROMA_HOST = "chroma"
 CHROMA_PERSIST_DIRECTORY = "/chroma"
 
-EMBEDDING_MODEL = "text-embedding-ada-002"
+# "openai" calls the OpenAI embeddings API, "local" runs a quantized multilingual model in-process on CPU
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "openai")
+EMBEDDING_MODELS = {
+    "openai": "text-embedding-ada-002",
+    "local": "Xenova/paraphrase-multilingual-MiniLM-L12-v2",
+}
+EMBEDDING_MODEL = EMBEDDING_MODELS[EMBEDDING_BACKEND]
+# Embedding caches, Chroma collections and indexes of different models must never mix
+EMBEDDING_VERSION = re.sub(r"[^0-9A-Za-z]+", "-", EMBEDDING_MODEL).strip("-").lower()
 KNOWLEDGE_BASE_DIR = "./knowledge_base"
 
+# "hybrid" scores BM25 and a memory-mapped embedding matrix in-process in one pass, "chroma" runs a BM25 and a
+# Chroma retriever per collection concurrently and fuses their lists with reciprocal-rank fusion
+RETRIEVER_BACKEND = os.environ.get("RETRIEVER_BACKEND", "hybrid")
+
+# Hybrid backend: BM25 (saturated, s / (s + bm25_saturation)) and semantic scores are both in [0, 1], fused
+# with the weights and compared with score_threshold; every collection contributes at most k documents
+HYBRID_RETRIEVER_SETTINGS = {
+    "info": {"weights": {"bm25": 0.4, "semantic": 0.6}, "score_threshold": 0.35, "k": 3},
+    "links": {"weights": {"semantic": 1.0}, "score_threshold": 0.35, "k": 1},
+}
+RETRIEVER_K = 4
+
+# Chroma backend
 RETRIEVER_COLLECTION_SETTINGS = {
-    "info": [{"name": "bm25", "k": 1, "score_threshold": 0.35}, {"name": "semantic", "k": 3, "score_threshold": 0.35}],
+    "info": [{"name": "bm25", "k": 1}, {"name": "semantic", "k": 3, "score_threshold": 0.35}],
     "links": [{"name": "semantic", "k": 1}]
 }
 
+# Client-side budgets of the OpenAI account, shared through Redis by every process; the concurrency cap is per process
+LLM_TOKENS_PER_MINUTE = int(os.environ.get("LLM_TOKENS_PER_MINUTE", 90_000))
+LLM_REQUESTS_PER_MINUTE = int(os.environ.get("LLM_REQUESTS_PER_MINUTE", 3_500))
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 8))
+
+# Token budget for the retrieved passages stuffed into the RetrievalQA prompt
+CONTEXT_MAX_TOKENS = 1500
+
 CREATE_DATABASE = True
 
+def init_embeddings():
+    if EMBEDDING_BACKEND == "local":
+        from core.local_embeddings import OnnxEmbeddings
+
+        return OnnxEmbeddings(EMBEDDING_MODEL)
+    return OpenAIEmbeddings(model=EMBEDDING_MODEL)
+
 def init_chromadb():
     chroma_emb_client = chromadb.HttpClient(host=CHROMA_HOST, port=8000)
     chroma_emb_client._settings.is_persistent = True
     chroma_emb_client._settings.persist_directory=CHROMA_PERSIST_DIRECTORY
 
     redis_emb_client = redis.Redis(host=REDIS_HOST, port=6379, db=0)
-    redis_emb_store = RedisStore(client=redis_emb_client, namespace=EMBEDDING_MODEL)
+    redis_emb_store = RedisStore(client=redis_emb_client, namespace=EMBEDDING_VERSION)
 
-    cached_embedder = CachedEmbeddings.from_bytes_store(OpenAIEmbeddings(model=EMBEDDING_MODEL), redis_emb_store, namespace=EMBEDDING_MODEL)
+    cached_embedder = CachedEmbeddings.from_bytes_store(init_embeddings(), redis_emb_store, namespace=EMBEDDING_VERSION)
+    if EMBEDDING_BACKEND == "local":
+        # A local miss costs a few milliseconds, batching it with other callers would only add the window
+        cached_embedder.batch_window = 0
 
-    if CREATE_DATABASE:
-        collection_names = create_knowledge_vectordb(KNOWLEDGE_BASE_DIR, cached_embedder, chroma_emb_client, CHROMA_PERSIST_DIRECTORY)
-        print(collection_names)
+    # Only the Chroma backend reads the knowledge base collections
+    if CREATE_DATABASE and RETRIEVER_BACKEND == "chroma":
+        collection_stats = create_knowledge_vectordb(KNOWLEDGE_BASE_DIR, cached_embedder, chroma_emb_client, CHROMA_PERSIST_DIRECTORY,
+                                                     collection_version=EMBEDDING_VERSION)
+        print(collection_stats)
     return cached_embedder, chroma_emb_client
 
-def init_content_embeddings(cached_embedder, chroma_emb_client):
-    spacy_nlp = spacy.load("uk_core_news_sm")
+def init_chroma_retriever(cached_embedder, chroma_emb_client):
+    lemmatizer = get_lemmatizer()
 
     retrievers = []
     for collection_name, collection_config in RETRIEVER_COLLECTION_SETTINGS.items():
-        collection_retrievers = []
-
         for retriever_info in collection_config:
+            retriever_kwargs = {key: value for key, value in retriever_info.items() if key != "name"}
             if retriever_info["name"] == "bm25":
-                collection_texts = load_texts(os.path.join(KNOWLEDGE_BASE_DIR, collection_name))
-                bm25 = BM25Retriever.from_texts(collection_texts, preprocess_func=lambda x: [token.lemma_ for token in spacy_nlp(x)], **retriever_info)
-                collection_retrievers.append(bm25)
-            elif retriever_info["name"] == "semantic":
-                collection_db = Chroma(embedding_function=cached_embedder, collection_name=collection_name,
-                                    client=chroma_emb_client, persist_directory=CHROMA_PERSIST_DIRECTORY)
-                semantic_retriever = collection_db.as_retriever(search_type="similarity", search_kwargs=retriever_info)
-                collection_retrievers.append(semantic_retriever)
-
-        if len(collection_retrievers) > 1:
-            retrievers.append(EnsembleRetriever(retrievers=collection_retrievers))
-        else:
-            retrievers.append(collection_retrievers[0])
-
-    context_retriever = MergerRetriever(retrievers=retrievers) if len(retrievers) > 1 else retrievers[0]
-    return context_retriever
+                retriever = load_bm25_retriever(os.path.join(KNOWLEDGE_BASE_DIR, collection_name), lemmatizer,
+                                                **retriever_kwargs)
+            else:
+                collection_db = Chroma(embedding_function=cached_embedder,
+                                       collection_name=versioned_collection_name(collection_name, EMBEDDING_VERSION),
+                                       client=chroma_emb_client, persist_directory=CHROMA_PERSIST_DIRECTORY)
+                search_type = "similarity_score_threshold" if "score_threshold" in retriever_kwargs else "similarity"
+                retriever = collection_db.as_retriever(search_type=search_type, search_kwargs=retriever_kwargs)
+            retrievers.append(InstrumentedRetriever(retriever=retriever, name=f"{collection_name}.{retriever_info['name']}"))
+
+    # The context assembler fuses the per-retriever lists, the merger only serves the plain sync interface
+    return ParallelRetriever(retriever=MergerRetriever(retrievers=retrievers))
+
+def init_content_embeddings(cached_embedder, chroma_emb_client):
+    if RETRIEVER_BACKEND == "chroma":
+        context_retriever = init_chroma_retriever(cached_embedder, chroma_emb_client)
+    else:
+        context_retriever = HybridRetriever.from_settings(KNOWLEDGE_BASE_DIR, HYBRID_RETRIEVER_SETTINGS, cached_embedder,
+                                                          EMBEDDING_VERSION, get_lemmatizer(), k=RETRIEVER_K)
+    return ContextAssemblyRetriever(source=context_retriever, max_tokens=CONTEXT_MAX_TOKENS)
+
+@functools.lru_cache(maxsize=None)
+def init_llm_scheduler():
+    # A slow Redis falls back to the local budget quickly instead of holding up every LLM call
+    redis_scheduler_client = redis.Redis(host=REDIS_HOST, port=6379, db=3, socket_timeout=0.2,
+                                         socket_connect_timeout=0.2)
+    return LLMScheduler(LLM_TOKENS_PER_MINUTE, LLM_REQUESTS_PER_MINUTE, LLM_MAX_CONCURRENCY,
+                        redis_client=redis_scheduler_client)
+
+def knowledge_base_version():
+    documents = [doc for collection_name in RETRIEVER_COLLECTION_SETTINGS
+                 for doc in load_documents(os.path.join(KNOWLEDGE_BASE_DIR, collection_name))]
+    return knowledge_base_hash(documents)
 
 def init_qna_retrieval(context_retriever, cached_embedder, chroma_emb_client):
-    llm = ChatOpenAI(temperature=0, model="gpt-3.5-turbo", verbose=True)
+    llm = ScheduledChatOpenAI(temperature=0, model="gpt-3.5-turbo", streaming=True, verbose=True,
+                              scheduler=init_llm_scheduler())
 
     rqa_prompt_template = ChatPromptTemplate.from_messages([
         SystemMessagePromptTemplate.from_template(
@@ -116,44 +172,73 @@ def init_qna_retrieval(context_retriever, cached_embedder, chroma_emb_client):
     condense_chain = LLMChain(llm=llm, prompt=condense_prompt_template)
 
 
-    chroma_questions_db = Chroma(embedding_function=cached_embedder, collection_name="questionss",
+    chroma_questions_db = Chroma(embedding_function=cached_embedder,
+                                collection_name=versioned_collection_name("questionss", EMBEDDING_VERSION),
                                 client=chroma_emb_client, persist_directory=CHROMA_PERSIST_DIRECTORY)
     redis_qa_client = redis.Redis(host=REDIS_HOST, port=6379, db=3)
-    rqa_cache = CompletionCache(chroma_questions_db, redis_qa_client)
-    cached_conversational_rqa = CachedConversationalRQA(condense_chain, rqa_chain, rqa_cache)
+    rqa_cache = CompletionCache(chroma_questions_db, redis_qa_client, version=knowledge_base_version())
+    cached_conversational_rqa = CachedConversationalRQA(condense_chain, rqa_chain, rqa_cache,
+                                                        single_flight=RedisSingleFlight(redis_qa_client))
 
     return cached_conversational_rqa, llm
 
-def init_agent(cached_conversational_rqa, llm):
+def init_tool_cache():
+    redis_tool_client = redis.Redis(host=REDIS_HOST, port=6379, db=4)
+    return ToolResponseCache(redis_tool_client)
+
+@functools.lru_cache(maxsize=None)
+def init_chat_history_store():
+    redis_history_client = redis.Redis(host=REDIS_HOST, port=6379, db=2)
+    summary_llm = ScheduledChatOpenAI(temperature=0, model="gpt-3.5-turbo", scheduler=init_llm_scheduler(),
+                                      priority=PRIORITY_BACKGROUND)
+    return redis_history_client, summary_llm
+
+def init_chat_history(session_id):
+    redis_history_client, summary_llm = init_chat_history_store()
+    return BoundedRedisChatMessageHistory(session_id, redis_history_client, summary_llm=summary_llm)
+
+def load_faq_questions():
+    return [text.strip().splitlines()[0] for text in load_texts(os.path.join(KNOWLEDGE_BASE_DIR, "info")) if text.strip()]
+
+def init_router(cached_conversational_rqa, tool_cache):
+    faq_questions = load_faq_questions()
+    return IntentRouter(get_lemmatizer(), faq_questions, cached_conversational_rqa,
+                        tool_cache.wrap(get_package_info, Package),
+                        tool_cache.wrap(aget_package_info, Package, "get_package_info"))
+
+def init_agent(cached_conversational_rqa, llm, tool_cache):
     tools = [
         Tool(
             name="package_info",
-            func=get_package_info,
+            func=tool_cache.wrap(get_package_info, Package),
+            coroutine=tool_cache.wrap(aget_package_info, Package, "get_package_info"),
             args_schema=Package,
             description="Useful for when you need to get tracking details and other information about the package",
         ),
         StructuredTool.from_function(
-            func=calculate_delivery_cost,
+            func=tool_cache.wrap(calculate_delivery_cost, DeliveryCost),
+            coroutine=tool_cache.wrap(acalculate_delivery_cost, DeliveryCost, "calculate_delivery_cost"),
             args_schema=DeliveryCost,
             description="Useful for when you need to estimate the delivery cost"
         ),
         StructuredTool.from_function(
-            func=estimate_delivery_date,
+            func=tool_cache.wrap(estimate_delivery_date, DeliveryDetails),
+            coroutine=tool_cache.wrap(aestimate_delivery_date, DeliveryDetails, "estimate_delivery_date"),
             args_schema=DeliveryDetails,
             description="Useful for when you need to estimate package delivery date",
         ),
         Tool(
             name="question_answering",
             func=lambda question: cached_conversational_rqa(question, []),
+            coroutine=lambda question: cached_conversational_rqa.acall(question, []),
             args_schema=Question,
             description="Useful for answering any type of questions, always use it if user asks a question",
-            return_direct=True
         ),
         StructuredTool.from_function(
             func=get_invoice,
+            coroutine=to_thread_coroutine(get_invoice),
             args_schema=Invoice,
             description="Useful for creating invoice. Використовується для створення електронної накладної (ЕН)",
-            return_direct=True
         )
     ]
 
@@ -173,7 +258,11 @@ def init_agent(cached_conversational_rqa, llm):
         MessagesPlaceholder(variable_name="agent_scratchpad")
         ]
     )
-    agent = initialize_agent(tools, llm, agent=AgentType.OPENAI_FUNCTIONS, llm_prompt=agent_prompt_template, verbose=False)
+    # The multi-functions agent can request several tools in one step, which the executor runs concurrently.
+    # Multi-action agents reject return_direct tools, so the executor returns their output itself
+    agent = ParallelAgentExecutor.from_agent_and_tools(
+        agent=OpenAIMultiFunctionsAgent.from_llm_and_tools(llm, tools), tools=tools, verbose=False,
+        return_direct_tools=["question_answering", "get_invoice"])
     agent.max_iterations = 3
     agent.max_execution_time = 10
     agent.agent.prompt = agent_prompt_template
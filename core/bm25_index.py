@@ -0,0 +1,81 @@
+import functools
+import os
+import pickle
+
+import spacy
+from langchain.retrievers import BM25Retriever
+from rank_bm25 import BM25Okapi
+from spacy.tokens import Doc
+
+from core.utils import load_documents, knowledge_base_hash
+
+
+SPACY_MODEL = "uk_core_news_sm"
+BM25_INDEX_DIR = "./index/bm25"
+LEMMA_CACHE_SIZE = 50_000
+
+
+class Lemmatizer:
+    def __init__(self, model_name=SPACY_MODEL, cache_size=LEMMA_CACHE_SIZE):
+        self.name = model_name
+        # The lemmatizer only needs the morphology, dependency parsing and NER are pure overhead here
+        self.nlp = spacy.load(model_name, exclude=["parser", "ner"])
+        self.lemma = functools.lru_cache(maxsize=cache_size)(self._lemma)
+
+    def _lemma(self, word):
+        doc = Doc(self.nlp.vocab, words=[word])
+        for _, component in self.nlp.pipeline:
+            doc = component(doc)
+        return doc[0].lemma_
+
+    def __call__(self, text):
+        return [self.lemma(token.text) for token in self.nlp.tokenizer(text)]
+
+
+@functools.lru_cache(maxsize=None)
+def get_lemmatizer(model_name=SPACY_MODEL):
+    return Lemmatizer(model_name)
+
+
+def bm25_index_path(index_dir, collection_name, lemmatizer_name, kb_hash):
+    return os.path.join(index_dir, f"{collection_name}_{lemmatizer_name}_{kb_hash}.pkl")
+
+
+def build_bm25_index(documents, preprocess_func, index_path):
+    vectorizer = BM25Okapi([preprocess_func(doc.page_content) for doc in documents])
+
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as fp:
+        pickle.dump(vectorizer, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, index_path)
+    return vectorizer
+
+
+def load_bm25_index(collection_dir, lemmatizer, index_dir=BM25_INDEX_DIR):
+    documents = load_documents(collection_dir)
+    index_path = bm25_index_path(index_dir, os.path.basename(os.path.normpath(collection_dir)),
+                                 lemmatizer.name, knowledge_base_hash(documents))
+    if os.path.exists(index_path):
+        with open(index_path, "rb") as fp:
+            vectorizer = pickle.load(fp)
+    else:
+        vectorizer = build_bm25_index(documents, lemmatizer, index_path)
+    return vectorizer, documents
+
+
+def load_bm25_retriever(collection_dir, lemmatizer, index_dir=BM25_INDEX_DIR, **kwargs):
+    vectorizer, documents = load_bm25_index(collection_dir, lemmatizer, index_dir)
+    return BM25Retriever(vectorizer=vectorizer, docs=documents, preprocess_func=lemmatizer, **kwargs)
+
+
+if __name__ == "__main__":
+    import sys
+
+    knowledge_base_dir = sys.argv[1] if len(sys.argv) > 1 else "./knowledge_base/info"
+    lemmatizer = Lemmatizer()
+    documents = load_documents(knowledge_base_dir)
+    index_path = bm25_index_path(BM25_INDEX_DIR, os.path.basename(os.path.normpath(knowledge_base_dir)),
+                                 lemmatizer.name, knowledge_base_hash(documents))
+    build_bm25_index(documents, lemmatizer, index_path)
+    print(index_path)
@@ -0,0 +1,112 @@
+import argparse
+import asyncio
+import time
+
+from langchain.chains import LLMChain
+from langchain.prompts import ChatPromptTemplate
+from langchain.prompts.chat import SystemMessagePromptTemplate
+
+from core.agent import init_chromadb, init_content_embeddings, init_llm_scheduler, init_qna_retrieval, load_faq_questions
+from core.llm_scheduler import PRIORITY_BACKGROUND, ScheduledChatOpenAI, current_priority
+
+
+PARAPHRASE_PROMPT = ChatPromptTemplate.from_messages([
+    SystemMessagePromptTemplate.from_template(
+        template=("Rephrase the following customer question to the postal company Nova Poshta in {n} different ways, "
+                  "the way customers would ask it in a chat. Keep the meaning. Write each variant in Ukrainian "
+                  "on a separate line without numbering.\n\nQUESTION: {question}")
+    )]
+)
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute):
+        self.interval = 60 / requests_per_minute if requests_per_minute else 0
+        self.next_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            delay = self.next_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.next_at = max(self.next_at, time.monotonic()) + self.interval
+
+
+class CacheWarmer:
+    def __init__(self, cached_conversational_rqa, paraphrase_chain=None, n_paraphrases=3, concurrency=4,
+                 requests_per_minute=60):
+        self.rqa_chain = cached_conversational_rqa.rqa_chain
+        self.rqa_output_key = cached_conversational_rqa.rqa_output_key
+        self.cache = cached_conversational_rqa.cache
+        self.paraphrase_chain = paraphrase_chain
+        self.n_paraphrases = n_paraphrases
+        self.concurrency = concurrency
+        self.rate_limiter = RateLimiter(requests_per_minute)
+
+    async def paraphrase(self, question):
+        if self.paraphrase_chain is None or self.n_paraphrases <= 0:
+            return []
+        await self.rate_limiter.wait()
+        output = await self.paraphrase_chain.arun(question=question, n=self.n_paraphrases)
+        paraphrases = [line.strip(" -•\t") for line in output.splitlines() if line.strip(" -•\t")]
+        return paraphrases[:self.n_paraphrases]
+
+    async def warm_question(self, question, semaphore, stats):
+        async with semaphore:
+            if self.cache.contains(question):
+                stats["skipped"] += 1
+                return
+            try:
+                await self.rate_limiter.wait()
+                output = await self.rqa_chain.acall(question)
+                # As in CachedConversationalRQA, an answer without context (retrieval timed out or found nothing)
+                # is not cached
+                if not output.get("source_documents"):
+                    stats["no_context"] += 1
+                    print(f"Skipped {question!r}: no context was retrieved")
+                    return
+                completion = output[self.rqa_output_key]
+                paraphrases = await self.paraphrase(question)
+                # Paraphrases share the answer of the canonical question, so they cost one extra call in total
+                await asyncio.to_thread(self.cache.set_many,
+                                        [(prompt, completion) for prompt in [question] + paraphrases])
+            except Exception as e:
+                stats["failed"] += 1
+                print(f"Failed to warm up {question!r}: {e}")
+                return
+            stats["warmed"] += 1
+            stats["paraphrases"] += len(paraphrases)
+
+    async def warm(self, questions):
+        # Answers of previous knowledge base versions are dropped before the new ones are written
+        await asyncio.to_thread(self.cache.evict, True)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        stats = {"warmed": 0, "skipped": 0, "no_context": 0, "failed": 0, "paraphrases": 0}
+        await asyncio.gather(*(self.warm_question(question, semaphore, stats) for question in questions))
+        return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pre-warm the answer cache with the FAQ questions")
+    parser.add_argument("--paraphrases", type=int, default=3, help="paraphrases generated per question")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--rpm", type=int, default=60, help="max LLM requests per minute")
+    args = parser.parse_args(argv)
+
+    cached_embedder, chroma_emb_client = init_chromadb()
+    context_retriever = init_content_embeddings(cached_embedder, chroma_emb_client)
+    cached_conversational_rqa, _ = init_qna_retrieval(context_retriever, cached_embedder, chroma_emb_client)
+    paraphrase_llm = ScheduledChatOpenAI(temperature=0.7, model="gpt-3.5-turbo", scheduler=init_llm_scheduler())
+    paraphrase_chain = LLMChain(llm=paraphrase_llm, prompt=PARAPHRASE_PROMPT)
+    warmer = CacheWarmer(cached_conversational_rqa, paraphrase_chain, n_paraphrases=args.paraphrases,
+                         concurrency=args.concurrency, requests_per_minute=args.rpm)
+
+    # The shared LLMs yield to interactive chat traffic when the warm-up runs inside a serving process
+    current_priority.set(PRIORITY_BACKGROUND)
+    stats = asyncio.run(warmer.warm(load_faq_questions()))
+    print(f"Knowledge base version {cached_conversational_rqa.cache.version}: {stats}")
+
+
+if __name__ == "__main__":
+    main()
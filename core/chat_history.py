@@ -0,0 +1,105 @@
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain.memory.summary import SummarizerMixin
+from langchain.schema import BaseChatMessageHistory, SystemMessage
+from langchain.schema.messages import _message_to_dict, messages_from_dict
+
+from core.utils import RELEASE_LOCK_SCRIPT
+
+
+CHAT_HISTORY_TTL = 7 * 24 * 60 * 60
+MAX_HISTORY_MESSAGES = 20
+KEEP_HISTORY_MESSAGES = 8
+SUMMARY_LOCK_TIMEOUT = 120
+
+# Writes the new summary and drops the summarized messages only if they are still the head of the list
+COMMIT_SUMMARY_SCRIPT = """
+local n = tonumber(ARGV[1])
+local head = redis.call("lrange", KEYS[1], 0, n - 1)
+if #head ~= n then
+    return 0
+end
+for i = 1, n do
+    if head[i] ~= ARGV[i + 3] then
+        return 0
+    end
+end
+redis.call("set", KEYS[2], ARGV[2], "EX", ARGV[3])
+redis.call("ltrim", KEYS[1], n, -1)
+return 1
+"""
+
+logger = logging.getLogger(__name__)
+summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="history-summary")
+
+
+class BoundedRedisChatMessageHistory(BaseChatMessageHistory):
+    def __init__(self, session_id, redis_client, summary_llm=None, ttl=CHAT_HISTORY_TTL,
+                 max_messages=MAX_HISTORY_MESSAGES, keep_messages=KEEP_HISTORY_MESSAGES, key_prefix="chat_history:"):
+        self.session_id = session_id
+        self.redis_client = redis_client
+        self.summarizer = SummarizerMixin(llm=summary_llm) if summary_llm else None
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self.keep_messages = keep_messages
+        self.key = f"{key_prefix}{session_id}"
+        self.summary_key = f"{self.key}:summary"
+        self.summary_lock_key = f"{self.key}:summarizing"
+        self._commit_summary = redis_client.register_script(COMMIT_SUMMARY_SCRIPT)
+        self._release_lock = redis_client.register_script(RELEASE_LOCK_SCRIPT)
+
+    def read(self, start, end):
+        pipeline = self.redis_client.pipeline(transaction=False)
+        pipeline.get(self.summary_key)
+        pipeline.lrange(self.key, start, end)
+        summary, items = pipeline.execute()
+        messages = messages_from_dict([json.loads(item) for item in items])
+        if summary:
+            messages.insert(0, SystemMessage(content=f"Summary of the earlier conversation: {summary.decode()}"))
+        return messages
+
+    def tail(self, n):
+        return self.read(-n, -1)
+
+    @property
+    def messages(self):
+        return self.read(0, -1)
+
+    def add_message(self, message):
+        pipeline = self.redis_client.pipeline()
+        pipeline.rpush(self.key, json.dumps(_message_to_dict(message), ensure_ascii=False))
+        pipeline.expire(self.key, self.ttl)
+        pipeline.expire(self.summary_key, self.ttl)
+        length = pipeline.execute()[0]
+        # Trimming happens in batches, so the summary is updated once per max_messages - keep_messages turns
+        if length > self.max_messages:
+            if self.summarizer is None:
+                self.redis_client.ltrim(self.key, -self.keep_messages, -1)
+                return
+            # One summarization per session at a time, even across replicas
+            token = os.urandom(16).hex()
+            if self.redis_client.set(self.summary_lock_key, token, nx=True, ex=SUMMARY_LOCK_TIMEOUT):
+                summary_executor.submit(self.summarize_evicted, token)
+
+    def summarize_evicted(self, token):
+        try:
+            items = self.redis_client.lrange(self.key, 0, -self.keep_messages - 1)
+            if not items:
+                return
+            summary = self.redis_client.get(self.summary_key)
+            new_summary = self.summarizer.predict_new_summary(
+                messages_from_dict([json.loads(item) for item in items]), summary.decode() if summary else "")
+            # Only the summarized items are dropped, messages added meanwhile stay in the list
+            self._commit_summary(keys=[self.key, self.summary_key],
+                                 args=[len(items), new_summary, self.ttl, *items])
+        except Exception:
+            logger.exception("Failed to summarize the chat history of %s", self.session_id)
+            self.redis_client.ltrim(self.key, -self.max_messages, -1)
+        finally:
+            self._release_lock(keys=[self.summary_lock_key], args=[token])
+
+    def clear(self):
+        self.redis_client.delete(self.key, self.summary_key)
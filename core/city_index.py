@@ -0,0 +1,124 @@
+import bisect
+import difflib
+import json
+import os
+import re
+import threading
+import time
+
+from core.novaposhta_client import np_client
+
+
+CITY_INDEX_PATH = "./index/settlements.json"
+CITY_INDEX_MAX_AGE = 7 * 24 * 60 * 60
+CITY_INDEX_RETRY_INTERVAL = 60 * 60
+
+SETTLEMENT_PREFIXES = re.compile(r"^(м\.|місто|смт\.?|селище|с\.|село)\s+")
+APOSTROPHES = re.compile(r"[’ʼ`´‘]")
+
+
+def normalize_city_name(name):
+    name = APOSTROPHES.sub("'", name.lower())
+    name = re.sub(r"\(.*?\)", " ", name)
+    name = " ".join(name.replace("-", " ").split())
+    return SETTLEMENT_PREFIXES.sub("", name).strip()
+
+
+class CityIndex:
+    def __init__(self, settlements=()):
+        self.refs = {}
+        # Cities win over villages with the same name, they are what users mean in the vast majority of cases
+        for settlement in sorted(settlements, key=lambda s: s.get("SettlementTypeDescription") != "місто"):
+            self.refs.setdefault(normalize_city_name(settlement["Description"]), settlement["Ref"])
+        self.names = sorted(self.refs)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, encoding="utf-8") as fp:
+            return cls(json.load(fp))
+
+    def __len__(self):
+        return len(self.names)
+
+    def lookup(self, city_name, fuzzy_cutoff=0.8):
+        name = normalize_city_name(city_name)
+        if not name:
+            return
+        if name in self.refs:
+            return self.refs[name]
+
+        start = bisect.bisect_left(self.names, name)
+        end = bisect.bisect_right(self.names, name + "\uffff")
+        if start < end:
+            return self.refs[min(self.names[start:end], key=len)]
+
+        # Misspellings rarely touch the first letter, so only names sharing it are compared
+        start = bisect.bisect_left(self.names, name[0])
+        end = bisect.bisect_right(self.names, name[0] + "\uffff")
+        matches = difflib.get_close_matches(name, self.names[start:end], n=1, cutoff=fuzzy_cutoff)
+        if matches:
+            return self.refs[matches[0]]
+
+
+def download_settlements(client=np_client, limit=150):
+    settlements = []
+    page = 1
+    while True:
+        response = client.call("Address", "getSettlements", {"Warehouse": "1", "Page": str(page), "Limit": str(limit)})
+        if not response["success"] or not response["data"]:
+            break
+        settlements.extend({key: item.get(key, "") for key in ("Description", "Ref", "SettlementTypeDescription")}
+                           for item in response["data"])
+        page += 1
+    return settlements
+
+
+def refresh_city_index(path=CITY_INDEX_PATH, client=np_client):
+    settlements = download_settlements(client)
+    if not settlements:
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fp:
+        json.dump(settlements, fp, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp_path, path)
+    return CityIndex(settlements)
+
+
+class CityIndexLoader:
+    def __init__(self, path=CITY_INDEX_PATH, max_age=CITY_INDEX_MAX_AGE, retry_interval=CITY_INDEX_RETRY_INTERVAL):
+        self.path = path
+        self.max_age = max_age
+        self.retry_interval = retry_interval
+        self.index = None
+        self._refreshing = False
+        self._last_refresh_attempt = 0
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        try:
+            index = refresh_city_index(self.path)
+            if index is not None:
+                self.index = index
+        finally:
+            self._refreshing = False
+
+    def get(self):
+        with self._lock:
+            if self.index is None:
+                self.index = CityIndex.from_file(self.path) if os.path.exists(self.path) else CityIndex()
+            is_stale = not os.path.exists(self.path) or time.time() - os.path.getmtime(self.path) > self.max_age
+            if is_stale and not self._refreshing and time.time() - self._last_refresh_attempt > self.retry_interval:
+                # The old dump keeps serving while the fresh one downloads
+                self._refreshing = True
+                self._last_refresh_attempt = time.time()
+                threading.Thread(target=self._refresh, daemon=True).start()
+        return self.index
+
+
+city_index_loader = CityIndexLoader()
+
+
+if __name__ == "__main__":
+    index = refresh_city_index()
+    print(f"{len(index) if index else 0} settlements saved to {CITY_INDEX_PATH}")
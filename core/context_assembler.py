@@ -0,0 +1,58 @@
+from collections import defaultdict
+
+from langchain.schema import BaseRetriever, Document
+
+from core.instrumentation import DEFAULT_MODEL_NAME, count_tokens, get_encoding, span
+from core.utils import content_hash
+
+
+class ContextAssemblyRetriever(BaseRetriever):
+    source: BaseRetriever
+    max_tokens: int = 1500
+    rrf_k: int = 60
+    model_name: str = DEFAULT_MODEL_NAME
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        return self.assemble(self.source.get_document_lists(query))
+
+    async def _aget_relevant_documents(self, query, *, run_manager=None):
+        return self.assemble(await self.source.aget_document_lists(query))
+
+    def fuse(self, doc_lists):
+        # Reciprocal rank fusion, a passage found by several retrievers adds up its scores instead of repeating
+        scores = defaultdict(float)
+        docs = {}
+        for doc_list in doc_lists:
+            for rank, doc in enumerate(doc_list):
+                doc_hash = content_hash(doc.page_content)
+                scores[doc_hash] += 1 / (self.rrf_k + rank + 1)
+                docs.setdefault(doc_hash, doc)
+        return [docs[doc_hash] for doc_hash in sorted(scores, key=scores.get, reverse=True)]
+
+    @staticmethod
+    def deduplicate(docs):
+        unique_docs = {}
+        for doc in docs:
+            unique_docs.setdefault(content_hash(doc.page_content), doc)
+        return list(unique_docs.values())
+
+    def truncate(self, text):
+        encoding = get_encoding(self.model_name)
+        return encoding.decode(encoding.encode(text)[:self.max_tokens])
+
+    def assemble(self, doc_lists):
+        with span("context_assembly"):
+            packed_docs = []
+            used_tokens = 0
+            # A single list comes already ranked by fused scores (hybrid backend), RRF is for several retrievers
+            ranked_docs = self.fuse(doc_lists) if len(doc_lists) > 1 else self.deduplicate(doc_lists[0] if doc_lists else [])
+            for doc in ranked_docs:
+                doc_tokens = count_tokens(doc.page_content, self.model_name)
+                if used_tokens + doc_tokens <= self.max_tokens:
+                    packed_docs.append(doc)
+                    used_tokens += doc_tokens
+                elif not packed_docs:
+                    # The best passage alone is over the budget, a truncated one beats an empty context
+                    packed_docs.append(Document(page_content=self.truncate(doc.page_content), metadata=doc.metadata))
+                    used_tokens = self.max_tokens
+            return packed_docs
@@ -0,0 +1,25 @@
+import glob
+import os
+
+# Workers write their metrics to files here and the master serves all of them on one port, so the exporter
+# does not depend on the number of workers
+PROMETHEUS_MULTIPROC_DIR = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9100))
+
+os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+for path in glob.glob(os.path.join(PROMETHEUS_MULTIPROC_DIR, "*.db")):
+    os.remove(path)
+
+
+def when_ready(server):
+    from prometheus_client import CollectorRegistry, multiprocess, start_http_server
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    start_http_server(METRICS_PORT, registry=registry)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
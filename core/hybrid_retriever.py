@@ -0,0 +1,108 @@
+import asyncio
+import os
+from typing import Any, List, Optional
+
+import numpy as np
+from langchain.schema import BaseRetriever
+
+from core.bm25_index import load_bm25_index
+from core.instrumentation import span
+from core.matrix_retriever import MATRIX_INDEX_DIR, load_collection_matrix, relevance_scores
+
+# BM25 score that counts as half a match. Questions about the knowledge base score 10-40 on their document,
+# unrelated questions stay below 5 through common words alone
+BM25_SATURATION = 10.0
+
+
+class HybridCollection:
+    def __init__(self, name, docs, bm25=None, matrix=None, weights=None, score_threshold=0.0, k=4,
+                 bm25_saturation=BM25_SATURATION):
+        self.name = name
+        self.docs = docs
+        self.bm25 = bm25
+        self.matrix = matrix
+        self.weights = weights or {}
+        self.score_threshold = score_threshold
+        self.k = k
+        self.bm25_saturation = bm25_saturation
+
+    def bm25_scores(self, lemmas):
+        # Saturated on a fixed scale rather than relative to the best hit, so an unrelated query that only shares
+        # common words stays below the threshold
+        scores = np.clip(np.asarray(self.bm25.get_scores(lemmas), dtype=np.float32), 0.0, None)
+        return scores / (scores + self.bm25_saturation)
+
+    def scores(self, lemmas, query_embedding):
+        fused = np.zeros(len(self.docs), dtype=np.float32)
+        if self.weights.get("bm25"):
+            fused += self.weights["bm25"] * self.bm25_scores(lemmas)
+        if self.weights.get("semantic"):
+            fused += self.weights["semantic"] * relevance_scores(self.matrix @ query_embedding)
+        return fused
+
+
+class HybridRetriever(BaseRetriever):
+    collections: List[Any]
+    embedder: Any
+    lemmatizer: Any
+    k: int = 4
+    timeout: Optional[float] = 2.0
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    @classmethod
+    def from_settings(cls, knowledge_base_dir, collection_settings, embedder, model_name, lemmatizer,
+                      index_dir=MATRIX_INDEX_DIR, **kwargs):
+        collections = []
+        for collection_name, settings in collection_settings.items():
+            collection_dir = os.path.join(knowledge_base_dir, collection_name)
+            weights = settings["weights"]
+            bm25 = matrix = docs = None
+            if weights.get("bm25"):
+                bm25, docs = load_bm25_index(collection_dir, lemmatizer)
+            if weights.get("semantic"):
+                # Both indexes are built from load_documents, so row i of the matrix is document i of BM25
+                matrix, docs = load_collection_matrix(collection_dir, embedder, model_name, index_dir)
+            collections.append(HybridCollection(collection_name, docs, bm25=bm25, matrix=matrix, weights=weights,
+                                                score_threshold=settings.get("score_threshold", 0.0),
+                                                k=settings.get("k", 4),
+                                                bm25_saturation=settings.get("bm25_saturation", BM25_SATURATION)))
+        return cls(collections=collections, embedder=embedder, lemmatizer=lemmatizer, **kwargs)
+
+    def scored_documents(self, query):
+        needs_bm25 = any(collection.weights.get("bm25") for collection in self.collections)
+        needs_embedding = any(collection.weights.get("semantic") for collection in self.collections)
+        lemmas = self.lemmatizer(query) if needs_bm25 else []
+        query_embedding = None
+        if needs_embedding:
+            query_embedding = np.asarray(self.embedder.embed_query(query), dtype=np.float32)
+            query_embedding /= np.linalg.norm(query_embedding)
+
+        scored_docs = []
+        for collection in self.collections:
+            with span(f"retriever.{collection.name}"):
+                scores = collection.scores(lemmas, query_embedding)
+                k = min(collection.k, len(scores))
+                top_indices = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(k)
+                scored_docs.extend((float(scores[i]), collection.docs[i]) for i in top_indices
+                                   if scores[i] >= collection.score_threshold)
+        scored_docs.sort(key=lambda scored_doc: scored_doc[0], reverse=True)
+        return scored_docs[:self.k]
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        return [doc for _, doc in self.scored_documents(query)]
+
+    async def _aget_relevant_documents(self, query, *, run_manager=None):
+        # Same contract as ParallelRetriever: a slow query embedding yields no context instead of a stuck answer
+        try:
+            return await asyncio.wait_for(asyncio.to_thread(self._get_relevant_documents, query), self.timeout)
+        except asyncio.TimeoutError:
+            return []
+
+    def get_document_lists(self, query):
+        # Scores are already fused across retrievers, the assembler only deduplicates and packs this one list
+        return [self._get_relevant_documents(query)]
+
+    async def aget_document_lists(self, query):
+        return [await self._aget_relevant_documents(query)]
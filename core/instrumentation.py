@@ -0,0 +1,187 @@
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import tiktoken
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.callbacks.openai_info import get_openai_token_cost_for_model
+from prometheus_client import Counter, Histogram, start_http_server
+
+
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9100))
+JSON_TRACE_LOGS = os.environ.get("JSON_TRACE_LOGS", "0") == "1"
+DEFAULT_MODEL_NAME = "gpt-3.5-turbo"
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+STAGE_LATENCY = Histogram("novaposhta_stage_latency_seconds", "Latency of a pipeline stage", ["stage"],
+                          buckets=LATENCY_BUCKETS)
+REQUEST_LATENCY = Histogram("novaposhta_request_latency_seconds", "End-to-end latency of a chat message",
+                            buckets=LATENCY_BUCKETS)
+LLM_TOKENS = Counter("novaposhta_llm_tokens_total", "LLM tokens used", ["stage", "kind"])
+LLM_COST = Counter("novaposhta_llm_cost_usd_total", "Estimated LLM cost in USD", ["stage"])
+
+logger = logging.getLogger(__name__)
+trace_logger = logging.getLogger("core.trace")
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+_metrics_server_lock = threading.Lock()
+_metrics_server_started = False
+
+
+def start_metrics_server(port=METRICS_PORT):
+    global _metrics_server_started
+    # In multiprocess mode the gunicorn master serves the metrics of every worker (core/gunicorn.conf.py)
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        return
+    with _metrics_server_lock:
+        if not _metrics_server_started:
+            try:
+                start_http_server(port)
+            except OSError:
+                # Another process of the service already exports on this port, answering chats matters more
+                logger.warning("Metrics port %s is taken, metrics of this process are not exported", port)
+            _metrics_server_started = True
+
+
+class Trace:
+    def __init__(self, session_id=None):
+        self.trace_id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.started_at = time.time()
+        self.duration = None
+        self.spans = []
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+        self._lock = threading.Lock()
+
+    def add_span(self, stage, started_at, duration, **attributes):
+        with self._lock:
+            self.spans.append({"stage": stage, "start": started_at - self.started_at,
+                               "duration": duration, **attributes})
+
+    def add_usage(self, prompt_tokens, completion_tokens, cost):
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.cost += cost
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "session_id": self.session_id,
+            "duration": self.duration,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cost": self.cost,
+            "spans": self.spans,
+        }
+
+
+def record_span(stage, started_at, duration, trace=None, **attributes):
+    STAGE_LATENCY.labels(stage).observe(duration)
+    trace = trace or current_trace.get()
+    if trace is not None:
+        trace.add_span(stage, started_at, duration, **attributes)
+
+
+@contextmanager
+def span(stage, **attributes):
+    started_at = time.time()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(stage, started_at, time.perf_counter() - start, **attributes)
+
+
+@contextmanager
+def trace_request(session_id=None):
+    trace = Trace(session_id)
+    token = current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        trace.duration = time.time() - trace.started_at
+        REQUEST_LATENCY.observe(trace.duration)
+        current_trace.reset(token)
+        if JSON_TRACE_LOGS:
+            trace_logger.info(json.dumps(trace.to_dict(), ensure_ascii=False))
+
+
+class InstrumentationHandler(BaseCallbackHandler):
+    def __init__(self, stage, trace=None):
+        self.stage = stage
+        # Callbacks of async chains may run in an executor thread without the caller's context
+        self.trace = trace or current_trace.get()
+        self.llm_calls = 0
+        self._runs = {}
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        model_kwargs = serialized.get("kwargs", {})
+        model_name = model_kwargs.get("model_name") or model_kwargs.get("model") or DEFAULT_MODEL_NAME
+        self.llm_calls += 1
+        self._runs[run_id] = {"start": time.perf_counter(), "started_at": time.time(), "model_name": model_name,
+                              "iteration": self.llm_calls, "prompt_tokens": count_tokens("".join(prompts), model_name),
+                              "completion_tokens": 0}
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        run = self._runs.get(run_id)
+        if run is not None:
+            run["completion_tokens"] += 1
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        # Streaming responses carry no usage, then the tiktoken estimates are used
+        token_usage = (response.llm_output or {}).get("token_usage") or {}
+        prompt_tokens = token_usage.get("prompt_tokens", run["prompt_tokens"])
+        completion_tokens = token_usage.get("completion_tokens", run["completion_tokens"])
+        try:
+            cost = (get_openai_token_cost_for_model(run["model_name"], prompt_tokens)
+                    + get_openai_token_cost_for_model(run["model_name"], completion_tokens, is_completion=True))
+        except ValueError:
+            cost = 0.0
+
+        LLM_TOKENS.labels(self.stage, "prompt").inc(prompt_tokens)
+        LLM_TOKENS.labels(self.stage, "completion").inc(completion_tokens)
+        LLM_COST.labels(self.stage).inc(cost)
+        record_span(f"{self.stage}.llm", run["started_at"], time.perf_counter() - run["start"], trace=self.trace,
+                    iteration=run["iteration"], prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+        if self.trace is not None:
+            self.trace.add_usage(prompt_tokens, completion_tokens, cost)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._runs.pop(run_id, None)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._runs[run_id] = {"start": time.perf_counter(), "started_at": time.time(),
+                              "tool": serialized.get("name", "")}
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        run = self._runs.pop(run_id, None)
+        if run is not None:
+            record_span(f"{self.stage}.tool", run["started_at"], time.perf_counter() - run["start"], trace=self.trace,
+                        tool=run["tool"])
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self.on_tool_end(None, run_id=run_id)
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model_name=DEFAULT_MODEL_NAME):
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text, model_name=DEFAULT_MODEL_NAME):
+    return len(get_encoding(model_name).encode(text))
@@ -0,0 +1,293 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import json
+import threading
+import time
+from typing import Any, Optional
+
+import redis
+from langchain.chat_models import ChatOpenAI
+
+from core.instrumentation import count_tokens, current_trace, span
+
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+DEFAULT_COMPLETION_TOKENS = 256
+
+current_priority = contextvars.ContextVar("current_priority", default=PRIORITY_INTERACTIVE)
+
+# Refills both buckets from the Redis clock and takes one request with its tokens if both have enough,
+# otherwise returns how long to wait
+RESERVE_BUDGET_SCRIPT = """
+local tokens_per_minute = tonumber(ARGV[1])
+local requests_per_minute = tonumber(ARGV[2])
+local amount = tonumber(ARGV[3])
+local time = redis.call("time")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call("hmget", KEYS[1], "tokens", "requests", "updated_at")
+local elapsed = math.max(0, now - (tonumber(state[3]) or now))
+local tokens = math.min(tokens_per_minute, (tonumber(state[1]) or tokens_per_minute) + elapsed * tokens_per_minute / 60)
+local requests = math.min(requests_per_minute,
+                          (tonumber(state[2]) or requests_per_minute) + elapsed * requests_per_minute / 60)
+local wait_time = math.max(0, (math.min(amount, tokens_per_minute) - tokens) * 60 / tokens_per_minute,
+                           (1 - requests) * 60 / requests_per_minute)
+if wait_time == 0 then
+    tokens = tokens - amount
+    requests = requests - 1
+end
+redis.call("hset", KEYS[1], "tokens", tokens, "requests", requests, "updated_at", now)
+redis.call("expire", KEYS[1], 120)
+return tostring(wait_time)
+"""
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.available = float(per_minute)
+        self.updated_at = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount):
+        # A request bigger than the whole budget waits for a full bucket instead of forever
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.available) / self.rate)
+
+
+class LocalRateBudget:
+    def __init__(self, tokens_per_minute, requests_per_minute):
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.requests = TokenBucket(requests_per_minute)
+
+    def reserve(self, estimated_tokens):
+        self.tokens.refill()
+        self.requests.refill()
+        wait_time = max(self.tokens.wait_time(estimated_tokens), self.requests.wait_time(1))
+        if wait_time == 0:
+            self.tokens.available -= estimated_tokens
+            self.requests.available -= 1
+        return wait_time
+
+    def refund(self, tokens):
+        self.tokens.available += tokens
+
+
+class RedisRateBudget:
+    # The provider limits are per account, so every process (server workers, the cache warmer) draws from one budget
+    def __init__(self, redis_client, tokens_per_minute, requests_per_minute, key="llm_budget"):
+        self.redis_client = redis_client
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.key = key
+        self._reserve = redis_client.register_script(RESERVE_BUDGET_SCRIPT)
+        # Used while Redis is unreachable, so LLM calls are still limited per process
+        self.fallback = LocalRateBudget(tokens_per_minute, requests_per_minute)
+
+    def reserve(self, estimated_tokens):
+        try:
+            return float(self._reserve(keys=[self.key],
+                                       args=[self.tokens_per_minute, self.requests_per_minute, estimated_tokens]))
+        except redis.RedisError:
+            return self.fallback.reserve(estimated_tokens)
+
+    def refund(self, tokens):
+        try:
+            self.redis_client.hincrbyfloat(self.key, "tokens", tokens)
+        except redis.RedisError:
+            self.fallback.refund(tokens)
+
+
+class LLMPermit:
+    def __init__(self, estimated_tokens):
+        self.estimated_tokens = estimated_tokens
+
+
+class LLMScheduler:
+    def __init__(self, tokens_per_minute=90_000, requests_per_minute=3_500, max_concurrency=8, redis_client=None):
+        self.budget = (RedisRateBudget(redis_client, tokens_per_minute, requests_per_minute) if redis_client
+                       else LocalRateBudget(tokens_per_minute, requests_per_minute))
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self._queue = []
+        self._sequence = itertools.count()
+        # Start-time fair queuing: a session with many queued calls does not delay the first call of another one
+        self._virtual_time = 0
+        self._flow_finish = {}
+        self._condition = threading.Condition()
+        self._async_waiters = set()
+        # The entry whose budget is being reserved; the reservation may be a Redis round-trip, so it runs outside
+        # the lock, one at a time
+        self._reserving = None
+
+    def _enqueue(self, priority, flow):
+        start = max(self._virtual_time, self._flow_finish.get(flow, 0))
+        self._flow_finish[flow] = start + 1
+        entry = (priority, start, next(self._sequence))
+        heapq.heappush(self._queue, entry)
+        return entry
+
+    def _dequeue(self, entry):
+        self._queue.remove(entry)
+        heapq.heapify(self._queue)
+
+    def _notify_all(self):
+        self._condition.notify_all()
+        for loop, event in self._async_waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def _claim(self, entry):
+        # Called with the lock held: only the head of the queue reserves budget, and only for a free slot
+        if self._reserving is not None or self._queue[0] != entry or self.in_flight >= self.max_concurrency:
+            return False
+        self._reserving = entry
+        return True
+
+    def _reserved(self, entry, wait_time):
+        # Called with the lock held after the reservation: 0 takes the permit, None (a failed reservation) gives up
+        self._reserving = None
+        if wait_time == 0 or wait_time is None:
+            self._dequeue(entry)
+        if wait_time == 0:
+            self._virtual_time = max(self._virtual_time, entry[1])
+            self._flow_finish = {flow: finish for flow, finish in self._flow_finish.items()
+                                 if finish > self._virtual_time}
+            self.in_flight += 1
+        self._notify_all()
+
+    def acquire(self, estimated_tokens, priority=None, flow=None):
+        priority = current_priority.get() if priority is None else priority
+        with self._condition:
+            entry = self._enqueue(priority, flow)
+        while True:
+            with self._condition:
+                while not self._claim(entry):
+                    self._condition.wait()
+            wait_time = None
+            try:
+                wait_time = self.budget.reserve(estimated_tokens)
+            finally:
+                with self._condition:
+                    self._reserved(entry, wait_time)
+                    if wait_time:
+                        self._condition.wait(wait_time)
+            if wait_time == 0:
+                return LLMPermit(estimated_tokens)
+
+    def release(self, permit, used_tokens=None):
+        # Estimates are corrected with the reported usage, so the budget follows what the provider counts
+        if used_tokens is not None:
+            self.budget.refund(permit.estimated_tokens - used_tokens)
+        with self._condition:
+            self.in_flight -= 1
+            self._notify_all()
+
+    def _abandon_reservation(self, entry, estimated_tokens, reserving):
+        # The caller was cancelled while its reservation was running, the budget it got is handed back
+        wait_time = None if reserving.cancelled() or reserving.exception() else reserving.result()
+        with self._condition:
+            self._reserving = None
+            self._notify_all()
+        if wait_time == 0:
+            self.budget.refund(estimated_tokens)
+
+    async def aacquire(self, estimated_tokens, priority=None, flow=None):
+        priority = current_priority.get() if priority is None else priority
+        # Waiting calls hold an event of their loop instead of a thread, releases from any thread set it
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._condition:
+            entry = self._enqueue(priority, flow)
+            self._async_waiters.add(waiter)
+        try:
+            while True:
+                with self._condition:
+                    claimed = self._claim(entry)
+                    waiter[1].clear()
+                if not claimed:
+                    await waiter[1].wait()
+                    continue
+
+                reserving = asyncio.ensure_future(asyncio.to_thread(self.budget.reserve, estimated_tokens))
+                try:
+                    wait_time = await asyncio.shield(reserving)
+                except asyncio.CancelledError:
+                    reserving.add_done_callback(
+                        lambda reserving: self._abandon_reservation(entry, estimated_tokens, reserving))
+                    raise
+                except BaseException:
+                    with self._condition:
+                        self._reserved(entry, None)
+                    raise
+                with self._condition:
+                    self._reserved(entry, wait_time)
+                    waiter[1].clear()
+                if wait_time == 0:
+                    return LLMPermit(estimated_tokens)
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), wait_time)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            with self._condition:
+                if entry in self._queue:
+                    self._dequeue(entry)
+                    self._notify_all()
+            raise
+        finally:
+            with self._condition:
+                self._async_waiters.discard(waiter)
+
+
+def estimate_tokens(messages, model_name, max_tokens=None, functions=None):
+    prompt = "".join(message.content or "" for message in messages)
+    if functions:
+        prompt += json.dumps(functions, ensure_ascii=False)
+    return count_tokens(prompt, model_name) + 4 * len(messages) + (max_tokens or DEFAULT_COMPLETION_TOKENS)
+
+
+def current_flow():
+    trace = current_trace.get()
+    return trace.session_id if trace is not None else None
+
+
+def used_tokens(result):
+    return ((result.llm_output or {}).get("token_usage") or {}).get("total_tokens")
+
+
+class ScheduledChatOpenAI(ChatOpenAI):
+    scheduler: Any = None
+    priority: Optional[int] = None
+
+    def _estimate(self, messages, kwargs):
+        return estimate_tokens(messages, self.model_name, self.max_tokens, kwargs.get("functions"))
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.scheduler is None:
+            return super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        with span("llm_queue"):
+            permit = self.scheduler.acquire(self._estimate(messages, kwargs), self.priority, current_flow())
+        result = None
+        try:
+            result = super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            return result
+        finally:
+            self.scheduler.release(permit, used_tokens(result) if result is not None else None)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.scheduler is None:
+            return await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        with span("llm_queue"):
+            permit = await self.scheduler.aacquire(self._estimate(messages, kwargs), self.priority, current_flow())
+        result = None
+        try:
+            result = await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            return result
+        finally:
+            self.scheduler.release(permit, used_tokens(result) if result is not None else None)
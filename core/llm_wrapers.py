@@ -1,42 +1,310 @@
+import asyncio
+import contextvars
 import hashlib
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from typing import List, Optional
+
+from langchain.agents import AgentExecutor
+from langchain.agents.agent import ExceptionTool
+from langchain.agents.tools import InvalidTool
+from langchain.callbacks.base import BaseCallbackHandler
 from langchain.embeddings import CacheBackedEmbeddings
-from langchain.schema import get_buffer_string
+from langchain.retrievers import EnsembleRetriever
+from langchain.retrievers.merger_retriever import MergerRetriever
+from langchain.schema import AgentAction, AgentFinish, BaseRetriever, OutputParserException, get_buffer_string
+
+from core.instrumentation import InstrumentationHandler, span, trace_request
+from core.utils import LRUCache, SingleFlight
+
+
+# Set while a reply is being streamed, so chains called from inside tools can stream into the same handler
+current_stream_handler = contextvars.ContextVar("current_stream_handler", default=None)
+
+
+class TokenStreamHandler(BaseCallbackHandler):
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def on_llm_new_token(self, token, **kwargs):
+        if token:
+            self.queue.put(token)
+
+    def close(self):
+        self.queue.put(None)
+
+    def __iter__(self):
+        while (token := self.queue.get()) is not None:
+            yield token
 
 
 class CachedEmbeddings(CacheBackedEmbeddings):
+    def __init__(self, underlying_embeddings, document_embedding_store, batch_window=0.01, max_batch_size=512,
+                 chunk_size=128, max_retries=4, retry_base_delay=0.5):
+        super().__init__(underlying_embeddings, document_embedding_store)
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self._queue = queue.Queue()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        vectors = self.document_embedding_store.mget(texts)
+        missing = {text: None for text, vector in zip(texts, vectors) if vector is None}
+        if not missing:
+            return vectors
+
+        if self.batch_window <= 0:
+            # No window to wait for, the misses are embedded in the calling thread
+            embedded = dict(zip(missing, self._embed_missing(list(missing))))
+            return [vector if vector is not None else embedded[text] for text, vector in zip(texts, vectors)]
+
+        self._ensure_worker()
+        for text in missing:
+            missing[text] = Future()
+            self._queue.put((text, missing[text]))
+        return [vector if vector is not None else missing[text].result() for text, vector in zip(texts, vectors)]
+
     def embed_query(self, text):
         return self.embed_documents([text])[0]
 
+    def _ensure_worker(self):
+        with self._worker_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._batch_worker, daemon=True)
+                self._worker.start()
+
+    def _batch_worker(self):
+        while True:
+            pending = [self._queue.get()]
+            # Coalesce the misses of every caller that arrives within the window into one batch
+            deadline = time.monotonic() + self.batch_window
+            while len(pending) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            futures = {}
+            for text, future in pending:
+                futures.setdefault(text, []).append(future)
+            try:
+                vectors = self._embed_missing(list(futures))
+            except Exception as e:
+                for text_futures in futures.values():
+                    for future in text_futures:
+                        future.set_exception(e)
+            else:
+                for text, vector in zip(futures, vectors):
+                    for future in futures[text]:
+                        future.set_result(vector)
+
+    def _embed_missing(self, texts):
+        vectors = []
+        for i in range(0, len(texts), self.chunk_size):
+            chunk = texts[i:i + self.chunk_size]
+            chunk_vectors = self._embed_with_retry(chunk)
+            self.document_embedding_store.mset(list(zip(chunk, chunk_vectors)))
+            vectors.extend(chunk_vectors)
+        return vectors
+
+    def _embed_with_retry(self, texts):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.underlying_embeddings.embed_documents(texts)
+            except Exception:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self.retry_base_delay * 2 ** attempt * random.uniform(0.5, 1.5))
+
 
 class CompletionCache:
-    def __init__(self, chroma_db, redis_client, score_threshold=0.15):
+    def __init__(self, chroma_db, redis_client, score_threshold=0.15, ttl=7 * 24 * 60 * 60, max_size=10_000,
+                 local_max_size=1024, key_prefix="completion:", version=""):
         self.redis_client = redis_client
         self.chroma_db = chroma_db
         self.score_threshold = score_threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self.key_prefix = key_prefix
+        # Completions are tied to the knowledge base they were generated from, other versions are never served
+        self.version = version
+        self.local_cache = LRUCache(max_size=local_max_size, ttl=ttl)
+
+    @staticmethod
+    def normalize(prompt):
+        return " ".join(prompt.lower().split())
+
+    def key(self, prompt):
+        return hashlib.sha256(f"{self.version}\0{self.normalize(prompt)}".encode()).hexdigest()
 
     def get(self, prompt):
-        chroma_response = self.chroma_db.similarity_search_with_score(
-            prompt, k=1)
+        with span("cache_lookup"):
+            key = self.key(prompt)
+            completion = self.local_cache.get(key)
+            if completion is not None:
+                return completion
+
+            completion = self._redis_get(key)
+            if completion is None:
+                completion = self._semantic_get(prompt)
+            if completion is not None:
+                self.local_cache.set(key, completion)
+            return completion
+
+    async def aget(self, prompt):
+        return await asyncio.to_thread(self.get, prompt)
+
+    def contains(self, prompt):
+        return bool(self.redis_client.exists(self.key_prefix + self.key(prompt)))
+
+    def _redis_get(self, key):
+        completion = self.redis_client.get(self.key_prefix + key)
+        return completion.decode() if completion is not None else None
+
+    def _semantic_get(self, prompt):
+        with span("semantic_cache"):
+            chroma_response = self.chroma_db.similarity_search_with_score(
+                prompt, k=1, filter={"version": self.version})
         if chroma_response:
             document, score = chroma_response[0]
             if score < self.score_threshold:
-                return self.redis_client.get(document.page_content).decode()
+                return self._redis_get(document.metadata.get("key", self.key(document.page_content)))
 
     def set(self, prompt, completion):
+        self.set_many([(prompt, completion)])
+
+    def set_many(self, completions):
+        # Prompts that normalize to the same key would be duplicate Chroma ids in one add
+        completions = list({self.key(prompt): (prompt, completion) for prompt, completion in completions}.items())
+        keys = [key for key, _ in completions]
+        completions = [entry for _, entry in completions]
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for key, (_, completion) in zip(keys, completions):
+            self.local_cache.set(key, completion)
+            pipeline.set(self.key_prefix + key, completion, ex=self.ttl)
+        pipeline.execute()
+        created_at = time.time()
         self.chroma_db.add_texts(
-            [prompt], ids=[hashlib.sha256(prompt.encode()).hexdigest()])
-        self.redis_client.set(prompt, completion)
+            [self.normalize(prompt) for prompt, _ in completions],
+            metadatas=[{"key": key, "created_at": created_at, "version": self.version} for key in keys], ids=keys)
+        self.evict()
+
+    async def aset(self, prompt, completion):
+        await asyncio.to_thread(self.set, prompt, completion)
+
+    def evict(self, force=False):
+        collection = self.chroma_db._collection
+        if not force and collection.count() <= self.max_size:
+            return
+
+        records = collection.get(include=["metadatas"])
+        entries = sorted(zip(records["ids"], records["metadatas"]),
+                         key=lambda entry: (entry[1] or {}).get("created_at", 0))
+        expired_before = time.time() - self.ttl
+        is_stale = lambda metadata: (metadata.get("version", "") != self.version
+                                     or metadata.get("created_at", 0) < expired_before)
+        stale_ids = [doc_id for doc_id, metadata in entries if is_stale(metadata or {})]
+        entries = [(doc_id, metadata) for doc_id, metadata in entries if not is_stale(metadata or {})]
+        # Drop the stale entries, then the oldest ones, down to 90% of the cap so eviction runs rarely
+        n_evict = max(len(entries) - int(self.max_size * 0.9), 0)
+        evicted_ids = stale_ids + [doc_id for doc_id, _ in entries[:n_evict]]
+        if not evicted_ids:
+            return
+        collection.delete(ids=evicted_ids)
+        self.redis_client.delete(*[self.key_prefix + doc_id for doc_id in evicted_ids])
+        for doc_id in evicted_ids:
+            self.local_cache.delete(doc_id)
+
+
+class InstrumentedRetriever(BaseRetriever):
+    retriever: BaseRetriever
+    name: str
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        with span(f"retriever.{self.name}"):
+            return self.retriever.get_relevant_documents(query)
+
+    async def _aget_relevant_documents(self, query, *, run_manager=None):
+        with span(f"retriever.{self.name}"):
+            return await asyncio.to_thread(self.retriever.get_relevant_documents, query)
+
+
+class ParallelRetriever(BaseRetriever):
+    retriever: BaseRetriever
+    timeout: Optional[float] = 2.0
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        return self.retriever.get_relevant_documents(query)
+
+    async def _aget_relevant_documents(self, query, *, run_manager=None):
+        return await self._aretrieve(self.retriever, query)
+
+    async def _aretrieve(self, retriever, query):
+        # Fan out over the Merger/Ensemble tree so every leaf retriever runs concurrently
+        if isinstance(retriever, (MergerRetriever, EnsembleRetriever)):
+            doc_lists = await asyncio.gather(*(self._aretrieve(sub_retriever, query)
+                                               for sub_retriever in retriever.retrievers))
+            if isinstance(retriever, EnsembleRetriever):
+                return retriever.weighted_reciprocal_rank(doc_lists)
+            return [docs[i] for i in range(max(map(len, doc_lists), default=0)) for docs in doc_lists if i < len(docs)]
+
+        try:
+            return await asyncio.wait_for(asyncio.to_thread(retriever.get_relevant_documents, query), self.timeout)
+        except asyncio.TimeoutError:
+            return []
+
+    def leaf_retrievers(self, retriever=None):
+        retriever = retriever or self.retriever
+        if isinstance(retriever, (MergerRetriever, EnsembleRetriever)):
+            return [leaf for sub_retriever in retriever.retrievers for leaf in self.leaf_retrievers(sub_retriever)]
+        return [retriever]
+
+    def get_document_lists(self, query):
+        return [leaf.get_relevant_documents(query) for leaf in self.leaf_retrievers()]
+
+    async def aget_document_lists(self, query):
+        return await asyncio.gather(*(self._aretrieve(leaf, query) for leaf in self.leaf_retrievers()))
 
 
 class CachedConversationalRQA:
     def __init__(self, condense_chain, rqa_chain, rqa_cache, k=2,
-                 condense_output_key="text", rqa_output_key="result"):
+                 condense_output_key="text", rqa_output_key="result",
+                 cache_timeout=2.0, condense_timeout=10, llm_timeout=30, single_flight=None):
         self.condense_chain = condense_chain
         self.rqa_chain = rqa_chain
         self.cache = rqa_cache
         self.k = 2
         self.condense_output_key = condense_output_key
         self.rqa_output_key = rqa_output_key
+        # The lookup embeds the question (an OpenAI round-trip on an embedding cache miss) and queries Chroma,
+        # the "semantic_cache" span shows how long that takes
+        self.cache_timeout = cache_timeout
+        self.condense_timeout = condense_timeout
+        self.llm_timeout = llm_timeout
+        # Identical questions in flight at the same time share one LLM call, across replicas with a RedisSingleFlight
+        self.single_flight = single_flight
+        self.local_flight = SingleFlight()
+
+    def single_flight_do(self, question, func):
+        if self.single_flight is None:
+            return self.local_flight.do(self.cache.key(question), func)
+        return self.single_flight.do(self.cache.key(question), func, lambda: self.cache.get(question))
+
+    async def single_flight_ado(self, question, coroutine_func):
+        if self.single_flight is None:
+            return await self.local_flight.ado(self.cache.key(question), coroutine_func)
+        return await self.single_flight.ado(self.cache.key(question), coroutine_func, lambda: self.cache.get(question))
 
     def __call__(self, question, chat_messages):
         cached_completion = self.cache.get(question)
@@ -46,30 +314,224 @@ class CachedConversationalRQA:
         last_messages = chat_messages[-self.k * 2:] if self.k > 0 else []
         if last_messages:
             last_messages_str = get_buffer_string(last_messages)
-            question = self.condense_chain(
-                {"question": question, "last_messages": last_messages_str})[self.condense_output_key]
+            with span("condense"):
+                question = self.condense_chain(
+                    {"question": question, "last_messages": last_messages_str},
+                    callbacks=[InstrumentationHandler("condense")])[self.condense_output_key]
             rephrased_cache_completion = self.cache.get(question)
             if rephrased_cache_completion:
                 return rephrased_cache_completion
 
-        completion = self.rqa_chain(question)[self.rqa_output_key]
-        self.cache.set(question, completion)
-        return completion
+        stream_handler = current_stream_handler.get()
+        callbacks = [InstrumentationHandler("rqa")] + ([stream_handler] if stream_handler else [])
+
+        def answer():
+            with span("rqa"):
+                result = self.rqa_chain(question, callbacks=callbacks)
+            completion = result[self.rqa_output_key]
+            # An answer without context (retrieval timed out or found nothing) would stay cached for days
+            if result.get("source_documents"):
+                self.cache.set(question, completion)
+            return completion
+        return self.single_flight_do(question, answer)
+
+    async def _acache_get(self, question):
+        try:
+            return await asyncio.wait_for(self.cache.aget(question), self.cache_timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def acall(self, question, chat_messages):
+        last_messages = chat_messages[-self.k * 2:] if self.k > 0 else []
+        cache_task = asyncio.create_task(self._acache_get(question))
+        # Without history the question is final, so retrieval can start while the cache is probed
+        docs_task = None if last_messages else asyncio.create_task(
+            self.rqa_chain.retriever.aget_relevant_documents(question))
+
+        cached_completion = await cache_task
+        if cached_completion:
+            if docs_task:
+                docs_task.cancel()
+            return cached_completion
+
+        if last_messages:
+            last_messages_str = get_buffer_string(last_messages)
+            with span("condense"):
+                condense_output = await asyncio.wait_for(self.condense_chain.acall(
+                    {"question": question, "last_messages": last_messages_str},
+                    callbacks=[InstrumentationHandler("condense")]), self.condense_timeout)
+            question = condense_output[self.condense_output_key]
+            rephrased_cache_completion = await self._acache_get(question)
+            if rephrased_cache_completion:
+                return rephrased_cache_completion
+            docs_task = asyncio.create_task(self.rqa_chain.retriever.aget_relevant_documents(question))
+
+        stream_handler = current_stream_handler.get()
+        callbacks = [InstrumentationHandler("rqa")] + ([stream_handler] if stream_handler else [])
+
+        async def answer():
+            docs = await docs_task
+            with span("rqa"):
+                completion = await asyncio.wait_for(self.rqa_chain.combine_documents_chain.arun(
+                    input_documents=docs, question=question, callbacks=callbacks), self.llm_timeout)
+            # An answer without context (retrieval timed out or found nothing) would stay cached for days
+            if docs:
+                await self.cache.aset(question, completion)
+            return completion
+
+        try:
+            return await self.single_flight_ado(question, answer)
+        finally:
+            # A follower never awaits its own prefetch
+            docs_task.cancel()
+
+
+class ParallelAgentExecutor(AgentExecutor):
+    max_parallel_tools: int = 4
+    return_direct_tools: List[str] = []
+
+    def _get_tool_return(self, next_step_output):
+        agent_action, observation = next_step_output
+        if agent_action.tool in self.return_direct_tools:
+            return AgentFinish({self.agent.return_values[0]: observation}, "")
+        return super()._get_tool_return(next_step_output)
+
+    def _run_action(self, name_to_tool_map, color_mapping, agent_action, run_manager):
+        if run_manager:
+            run_manager.on_agent_action(agent_action, color="green")
+        tool_run_kwargs = self.agent.tool_run_logging_kwargs()
+        if agent_action.tool not in name_to_tool_map:
+            return InvalidTool().run(
+                {"requested_tool_name": agent_action.tool, "available_tool_names": list(name_to_tool_map)},
+                verbose=self.verbose, color=None, callbacks=run_manager.get_child() if run_manager else None,
+                **tool_run_kwargs)
+
+        tool = name_to_tool_map[agent_action.tool]
+        if tool.return_direct or tool.name in self.return_direct_tools:
+            tool_run_kwargs["llm_prefix"] = ""
+        return tool.run(agent_action.tool_input, verbose=self.verbose, color=color_mapping[agent_action.tool],
+                        callbacks=run_manager.get_child() if run_manager else None, **tool_run_kwargs)
+
+    def _parsing_error_step(self, error, run_manager):
+        # Same handling as AgentExecutor._take_next_step, driven by handle_parsing_errors
+        if isinstance(self.handle_parsing_errors, bool) and not self.handle_parsing_errors:
+            raise error
+        text = str(error)
+        if isinstance(self.handle_parsing_errors, bool):
+            if error.send_to_llm:
+                observation = str(error.observation)
+                text = str(error.llm_output)
+            else:
+                observation = "Invalid or incomplete response"
+        elif isinstance(self.handle_parsing_errors, str):
+            observation = self.handle_parsing_errors
+        elif callable(self.handle_parsing_errors):
+            observation = self.handle_parsing_errors(error)
+        else:
+            raise ValueError("Got unexpected type of `handle_parsing_errors`")
+        output = AgentAction("_Exception", observation, text)
+        if run_manager:
+            run_manager.on_agent_action(output, color="green")
+        observation = ExceptionTool().run(output.tool_input, verbose=self.verbose, color=None,
+                                          callbacks=run_manager.get_child() if run_manager else None,
+                                          **self.agent.tool_run_logging_kwargs())
+        return [(output, observation)]
+
+    def _take_next_step(self, name_to_tool_map, color_mapping, inputs, intermediate_steps, run_manager=None):
+        try:
+            intermediate_steps = self._prepare_intermediate_steps(intermediate_steps)
+            output = self.agent.plan(intermediate_steps, callbacks=run_manager.get_child() if run_manager else None,
+                                     **inputs)
+        except OutputParserException as e:
+            return self._parsing_error_step(e, run_manager)
+        if isinstance(output, AgentFinish):
+            return output
+        actions = [output] if isinstance(output, AgentAction) else output
+        if len(actions) == 1:
+            return [(actions[0], self._run_action(name_to_tool_map, color_mapping, actions[0], run_manager))]
+
+        # Every action of one step runs at once; each keeps the caller's context (stream handler, trace)
+        with ThreadPoolExecutor(max_workers=min(len(actions), self.max_parallel_tools)) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, self._run_action,
+                                       name_to_tool_map, color_mapping, agent_action, run_manager)
+                       for agent_action in actions]
+            return [(agent_action, future.result()) for agent_action, future in zip(actions, futures)]
 
 
 class LLMChatHandler:
-    def __init__(self, agent, chat_history, k=4):
+    def __init__(self, agent, chat_history, k=4, router=None):
         self.agent = agent
         self.chat_history = chat_history
         self.k = k
+        self.router = router
+        self.last_output = None
 
-    def send_message(self, message):
-        chat_messages = self.chat_history.messages[-self.k *
-                                                   2:] if self.k > 0 else []
-        agent_output = self.agent.run(
-            {"input": message, "chat_messages": get_buffer_string(chat_messages)})
+    def last_messages(self):
+        if self.k <= 0:
+            return []
+        # Bounded histories read only the tail (and the summary of older turns) instead of the whole session
+        if hasattr(self.chat_history, "tail"):
+            return self.chat_history.tail(self.k * 2)
+        return self.chat_history.messages[-self.k * 2:]
 
+    def save_turn(self, message, agent_output):
         self.chat_history.add_user_message(message)
         self.chat_history.add_ai_message(agent_output)
 
+    @property
+    def session_id(self):
+        return getattr(self.chat_history, "session_id", None)
+
+    def send_message(self, message, callbacks=None):
+        with trace_request(self.session_id):
+            with span("history_read"):
+                chat_messages = self.last_messages()
+            with span("route"):
+                agent_output = self.router.dispatch(message, chat_messages) if self.router else None
+            if agent_output is None:
+                agent_output = self.agent.run(
+                    {"input": message, "chat_messages": get_buffer_string(chat_messages)},
+                    callbacks=[InstrumentationHandler("agent")] + (callbacks or []))
+
+            with span("history_write"):
+                self.save_turn(message, agent_output)
+
+        return agent_output
+
+    def stream_message(self, message, loop):
+        # The answer is produced by asend_message on the given event loop, tokens are passed through a queue
+        stream_handler = TokenStreamHandler()
+
+        async def run_agent():
+            current_stream_handler.set(stream_handler)
+            try:
+                return await self.asend_message(message, callbacks=[stream_handler])
+            finally:
+                stream_handler.close()
+
+        result = asyncio.run_coroutine_threadsafe(run_agent(), loop)
+        streamed = False
+        for token in stream_handler:
+            streamed = True
+            yield token
+
+        self.last_output = result.result()
+        # Cached answers and tools that return directly without an LLM call have nothing to stream
+        if not streamed:
+            yield self.last_output
+
+    async def asend_message(self, message, callbacks=None):
+        with trace_request(self.session_id):
+            with span("history_read"):
+                chat_messages = await asyncio.to_thread(self.last_messages)
+            with span("route"):
+                agent_output = await self.router.adispatch(message, chat_messages) if self.router else None
+            if agent_output is None:
+                agent_output = await self.agent.arun(
+                    {"input": message, "chat_messages": get_buffer_string(chat_messages)},
+                    callbacks=[InstrumentationHandler("agent")] + (callbacks or []))
+
+            with span("history_write"):
+                await asyncio.to_thread(self.save_turn, message, agent_output)
+
         return agent_output
@@ -0,0 +1,65 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import onnxruntime
+from huggingface_hub import hf_hub_download
+from langchain.embeddings.base import Embeddings
+from tokenizers import Tokenizer
+
+
+LOCAL_EMBEDDING_MODEL = "Xenova/paraphrase-multilingual-MiniLM-L12-v2"
+LOCAL_EMBEDDING_FILE = "onnx/model_quantized.onnx"
+
+
+class OnnxEmbeddings(Embeddings):
+    def __init__(self, model_name=LOCAL_EMBEDDING_MODEL, model_file=LOCAL_EMBEDDING_FILE, batch_size=32,
+                 max_length=256, num_workers=2, num_threads=None):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.tokenizer = Tokenizer.from_file(hf_hub_download(model_name, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.tokenizer.enable_padding()
+
+        options = onnxruntime.SessionOptions()
+        # The workers share the cores instead of every inference run fighting over all of them
+        options.intra_op_num_threads = num_threads or max(1, (os.cpu_count() or 1) // num_workers)
+        self.session = onnxruntime.InferenceSession(hf_hub_download(model_name, model_file), options,
+                                                    providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="onnx-embeddings")
+
+    def _embed_batch(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([encoding.ids for encoding in encodings], dtype=np.int64)
+        attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            inputs["token_type_ids"] = np.zeros_like(input_ids)
+
+        token_embeddings = self.session.run(None, inputs)[0]
+        # Mean pooling over the real tokens, then normalized, as sentence-transformers does
+        mask = attention_mask[..., None].astype(np.float32)
+        embeddings = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        # Similar lengths in one batch keep the padding small
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        batches = [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        embeddings = [None] * len(texts)
+        for batch, batch_embeddings in zip(batches, self.executor.map(
+                lambda batch: self._embed_batch([texts[i] for i in batch]), batches)):
+            for i, embedding in zip(batch, batch_embeddings):
+                embeddings[i] = embedding.tolist()
+        return embeddings
+
+    def embed_query(self, text):
+        return self._embed_batch([text])[0].tolist()
+
+
+if __name__ == "__main__":
+    # Downloads the model at image build time, so the first request does not
+    OnnxEmbeddings().embed_query("Нова Пошта")
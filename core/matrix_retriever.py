@@ -0,0 +1,53 @@
+import json
+import os
+
+import numpy as np
+from langchain.schema import Document
+
+from core.utils import load_documents, knowledge_base_hash
+
+
+MATRIX_INDEX_DIR = "./index/embeddings"
+
+
+def matrix_index_path(index_dir, collection_name, model_name, kb_hash):
+    return os.path.join(index_dir, f"{collection_name}_{model_name}_{kb_hash}")
+
+
+def build_matrix_index(documents, embedder, index_path):
+    matrix = np.asarray(embedder.embed_documents([doc.page_content for doc in documents]), dtype=np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    tmp_suffix = f".{os.getpid()}.tmp"
+    with open(f"{index_path}.json{tmp_suffix}", "w", encoding="utf-8") as fp:
+        json.dump([{"page_content": doc.page_content, "metadata": doc.metadata} for doc in documents],
+                  fp, ensure_ascii=False)
+    with open(f"{index_path}.npy{tmp_suffix}", "wb") as fp:
+        np.save(fp, matrix)
+    os.replace(f"{index_path}.json{tmp_suffix}", f"{index_path}.json")
+    os.replace(f"{index_path}.npy{tmp_suffix}", f"{index_path}.npy")
+
+
+def load_matrix_index(index_path):
+    # Memory-mapped read-only, so every worker process on the host shares the same page-cached copy
+    matrix = np.load(f"{index_path}.npy", mmap_mode="r")
+    with open(f"{index_path}.json", encoding="utf-8") as fp:
+        docs = [Document(**doc) for doc in json.load(fp)]
+    return matrix, docs
+
+
+def load_collection_matrix(collection_dir, embedder, model_name, index_dir=MATRIX_INDEX_DIR):
+    documents = load_documents(collection_dir)
+    index_path = matrix_index_path(index_dir, os.path.basename(os.path.normpath(collection_dir)),
+                                   model_name, knowledge_base_hash(documents))
+    if not os.path.exists(f"{index_path}.npy"):
+        build_matrix_index(documents, embedder, index_path)
+    return load_matrix_index(index_path)
+
+
+def relevance_scores(similarities):
+    # Same scale as the relevance scores of the Chroma backend: Chroma returns the squared L2 distance, which is
+    # 2 - 2 * cosine for unit vectors, and LangChain maps it to 1 - distance / sqrt(2). Negative scores are clipped,
+    # the threshold drops them either way
+    return np.clip(1.0 - (2.0 - 2.0 * similarities) / np.sqrt(2.0), 0.0, None)
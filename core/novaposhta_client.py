@@ -0,0 +1,136 @@
+import asyncio
+import os
+import random
+import threading
+import time
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+from core.instrumentation import span
+
+
+NOVA_POSHTA_API_URL = "https://api.novaposhta.ua/v2.0/json/"
+
+
+class NovaPoshtaAPIError(Exception):
+    pass
+
+
+class CircuitOpenError(NovaPoshtaAPIError):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            # Half-open: after the cooldown one call is let through to probe the API
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError("Nova Poshta API is temporarily unavailable")
+            self.opened_at = time.monotonic()
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class NovaPoshtaClient:
+    def __init__(self, url=NOVA_POSHTA_API_URL, api_key=None, connect_timeout=2, read_timeout=5,
+                 max_retries=2, backoff_factor=0.3, pool_size=20, circuit_breaker=None):
+        self.url = url
+        self.api_key = api_key
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.pool_size = pool_size
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._async_session = None
+        self._async_session_loop = None
+
+    def request_json(self, model_name, called_method, method_properties):
+        request_json = {
+            "modelName": model_name,
+            "calledMethod": called_method,
+            "methodProperties": method_properties,
+        }
+        api_key = self.api_key or os.environ.get("NOVA_POST_API_KEY")
+        if api_key:
+            request_json["apiKey"] = api_key
+        return request_json
+
+    def backoff(self, attempt):
+        return self.backoff_factor * 2 ** attempt * random.uniform(0.5, 1.5)
+
+    def call(self, model_name, called_method, method_properties):
+        with span(f"nova_poshta.{called_method}"):
+            return self._call(model_name, called_method, method_properties)
+
+    async def acall(self, model_name, called_method, method_properties):
+        with span(f"nova_poshta.{called_method}"):
+            return await self._acall(model_name, called_method, method_properties)
+
+    def _call(self, model_name, called_method, method_properties):
+        request_json = self.request_json(model_name, called_method, method_properties)
+        self.circuit_breaker.before_call()
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.post(self.url, json=request_json, timeout=self.timeout)
+                if response.status_code < 500:
+                    self.circuit_breaker.record_success()
+                    return response.json()
+                error = NovaPoshtaAPIError(f"Nova Poshta API returned {response.status_code}")
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = NovaPoshtaAPIError(str(e))
+            if attempt < self.max_retries:
+                time.sleep(self.backoff(attempt))
+        self.circuit_breaker.record_failure()
+        raise error
+
+    async def _acall(self, model_name, called_method, method_properties):
+        request_json = self.request_json(model_name, called_method, method_properties)
+        self.circuit_breaker.before_call()
+        # aiohttp sessions are bound to the loop they were created in
+        loop = asyncio.get_running_loop()
+        if self._async_session is None or self._async_session.closed or self._async_session_loop is not loop:
+            self._async_session_loop = loop
+            self._async_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(connect=self.timeout[0], sock_read=self.timeout[1]))
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self._async_session.post(self.url, json=request_json) as response:
+                    if response.status < 500:
+                        self.circuit_breaker.record_success()
+                        return await response.json(content_type=None)
+                    error = NovaPoshtaAPIError(f"Nova Poshta API returned {response.status}")
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                error = NovaPoshtaAPIError(str(e))
+            if attempt < self.max_retries:
+                await asyncio.sleep(self.backoff(attempt))
+        self.circuit_breaker.record_failure()
+        raise error
+
+
+np_client = NovaPoshtaClient()
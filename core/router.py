@@ -0,0 +1,128 @@
+import asyncio
+import math
+import re
+from collections import Counter
+
+
+TRACKING_NUMBER = re.compile(r"(?<!\d)\d{14}(?!\d)")
+DATE = re.compile(r"\b\d{1,2}[./-]\d{1,2}[./-]\d{2,4}\b")
+PHONE = re.compile(r"(?<!\d)(?:\+?38)?0\d{9}(?!\d)")
+DIGIT_SEPARATORS = re.compile(r"(?<=\d)[\s-](?=\d)")
+WORD = re.compile(r"\w+")
+
+# A message is routed to tracking only if, apart from the number, it is this short
+MAX_TRACKING_EXTRA_WORDS = 6
+
+# Tool requests that need arguments extracted by the LLM, they are recognized only to keep them away from the FAQ
+TOOL_INTENT_EXAMPLES = {
+    "delivery_cost": [
+        "Скільки коштує доставка з Києва до Львова?",
+        "Яка вартість відправки посилки вагою 2 кг?",
+        "Порахуй ціну доставки коробки",
+        "How much does delivery cost?",
+    ],
+    "delivery_date": [
+        "Коли буде доставлена посилка з Одеси до Харкова?",
+        "Скільки днів йде посилка?",
+        "Яка дата доставки, якщо відправити завтра?",
+        "When will the parcel be delivered?",
+    ],
+    "invoice": [
+        "Створи накладну",
+        "Хочу оформити експрес-накладну на відправлення",
+        "Створити ЕН для відправки документів",
+        "Create an invoice",
+    ],
+    "tracking": [
+        "Де моя посилка?",
+        "Відстежити посилку",
+        "Який статус мого відправлення?",
+        "Track my package",
+    ],
+}
+
+
+def format_package_info(package_info):
+    if isinstance(package_info, dict):
+        return "\n".join(f"{key}: {value}" for key, value in package_info.items() if value)
+    return package_info
+
+
+class LemmaClassifier:
+    def __init__(self, lemmatizer, examples):
+        self.lemmatizer = lemmatizer
+        self.labels = []
+        tokenized = []
+        for label, texts in examples.items():
+            for text in texts:
+                self.labels.append(label)
+                tokenized.append(self.tokenize(text))
+
+        document_frequencies = Counter(lemma for lemmas in tokenized for lemma in set(lemmas))
+        self.idf = {lemma: math.log((1 + len(tokenized)) / (1 + df)) + 1 for lemma, df in document_frequencies.items()}
+        self.vectors = [self.vectorize(lemmas) for lemmas in tokenized]
+
+    def tokenize(self, text):
+        return [lemma.lower() for lemma in self.lemmatizer(text) if WORD.fullmatch(lemma)]
+
+    def vectorize(self, lemmas):
+        vector = {lemma: count * self.idf.get(lemma, 0.0) for lemma, count in Counter(lemmas).items()}
+        norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+        return {lemma: weight / norm for lemma, weight in vector.items()} if norm else {}
+
+    def scores(self, text):
+        vector = self.vectorize(self.tokenize(text))
+        scores = {}
+        for label, example_vector in zip(self.labels, self.vectors):
+            similarity = sum(weight * example_vector.get(lemma, 0.0) for lemma, weight in vector.items())
+            scores[label] = max(scores.get(label, 0.0), similarity)
+        return scores
+
+
+class IntentRouter:
+    def __init__(self, lemmatizer, faq_questions, cached_conversational_rqa, package_info_func, apackage_info_func,
+                 faq_threshold=0.5, faq_margin=0.15):
+        self.classifier = LemmaClassifier(lemmatizer, {"faq": faq_questions, **TOOL_INTENT_EXAMPLES})
+        self.cached_conversational_rqa = cached_conversational_rqa
+        self.package_info_func = package_info_func
+        self.apackage_info_func = apackage_info_func
+        self.faq_threshold = faq_threshold
+        self.faq_margin = faq_margin
+
+    def route(self, message):
+        compact_message = DIGIT_SEPARATORS.sub("", message)
+        tracking_numbers = TRACKING_NUMBER.findall(compact_message)
+        if len(tracking_numbers) == 1:
+            remainder = compact_message.replace(tracking_numbers[0], " ")
+            if len(WORD.findall(remainder)) <= MAX_TRACKING_EXTRA_WORDS:
+                return "tracking", tracking_numbers[0]
+            return None
+        # Dates, phones or several numbers mean a tool request with arguments, only the agent can fill those in
+        if tracking_numbers or DATE.search(message) or PHONE.search(compact_message):
+            return None
+
+        scores = self.classifier.scores(message)
+        faq_score = scores.pop("faq", 0.0)
+        if faq_score >= self.faq_threshold and faq_score - max(scores.values(), default=0.0) >= self.faq_margin:
+            return "faq", message
+        return None
+
+    def dispatch(self, message, chat_messages):
+        route = self.route(message)
+        if route is None:
+            return None
+        intent, argument = route
+        if intent == "tracking":
+            return format_package_info(self.package_info_func(argument))
+        # A message routed to the FAQ already reads as a standalone question, condensing it with the history
+        # would only add an LLM call on a cache miss
+        return self.cached_conversational_rqa(argument, [])
+
+    async def adispatch(self, message, chat_messages):
+        route = await asyncio.to_thread(self.route, message)
+        if route is None:
+            return None
+        intent, argument = route
+        if intent == "tracking":
+            return format_package_info(await self.apackage_info_func(argument))
+        return await self.cached_conversational_rqa.acall(argument, [])
@@ -0,0 +1,135 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+
+from flask import Flask, Response, request
+
+app = Flask(__name__)
+
+AGENT_WARM_UP = os.environ.get("AGENT_WARM_UP", "1") == "1"
+FALLBACK_OUTPUT = "Вибачте, але я не можу відповісти на дане запитання."
+STOPPED_OUTPUT = "Agent stopped due to iteration limit or time limit."
+STOPPED_FALLBACK_OUTPUT = ("Вибачте, але я не можу відповісти на дане запитання. "
+                           "Зверніться до служби підтримки.")
+
+logger = logging.getLogger(__name__)
+
+
+class AgentService:
+    def __init__(self):
+        self.agent = None
+        self.router = None
+        self.error = None
+        self._lock = threading.Lock()
+        # Messages are answered by the async pipeline, on one event loop shared by all request threads
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True, name="agent-loop").start()
+
+    @property
+    def ready(self):
+        return self.agent is not None
+
+    def warm_up(self):
+        # The whole chain is imported here, so importing the server (or the Streamlit client) stays cheap
+        with self._lock:
+            if self.agent is not None:
+                return
+            try:
+                from core.agent import (init_agent, init_chromadb, init_content_embeddings, init_qna_retrieval,
+                                        init_router, init_tool_cache)
+                from core.instrumentation import start_metrics_server
+
+                start_metrics_server()
+                cached_embedder, chroma_emb_client = init_chromadb()
+                context_retriever = init_content_embeddings(cached_embedder, chroma_emb_client)
+                cached_conversational_rqa, llm = init_qna_retrieval(context_retriever, cached_embedder, chroma_emb_client)
+                tool_cache = init_tool_cache()
+                self.router = init_router(cached_conversational_rqa, tool_cache)
+                self.agent = init_agent(cached_conversational_rqa, llm, tool_cache)
+                self.error = None
+            except Exception as e:
+                self.error = e
+                raise
+
+    def chat_handler(self, session_id):
+        from core.agent import init_chat_history
+        from core.llm_wrapers import LLMChatHandler
+
+        self.warm_up()
+        return LLMChatHandler(self.agent, init_chat_history(session_id), router=self.router)
+
+    def clear_history(self, session_id):
+        from core.agent import init_chat_history
+
+        init_chat_history(session_id).clear()
+
+
+service = AgentService()
+
+
+def final_output(output):
+    if output == STOPPED_OUTPUT:
+        return STOPPED_FALLBACK_OUTPUT
+    return output or FALLBACK_OUTPUT
+
+
+def stream_events(chat_handler, message):
+    try:
+        for token in chat_handler.stream_message(message, service.loop):
+            yield json.dumps({"token": token}, ensure_ascii=False) + "\n"
+        output = final_output(chat_handler.last_output)
+    except Exception:
+        logger.exception("Failed to answer a message")
+        output = FALLBACK_OUTPUT
+    yield json.dumps({"output": output}, ensure_ascii=False) + "\n"
+
+
+@app.route("/health", methods=["GET"])
+def health():
+    if service.ready:
+        return {"status": "ready"}
+    return {"status": "error" if service.error else "starting"}, 503
+
+
+@app.route("/warmup", methods=["POST"])
+def warmup():
+    try:
+        service.warm_up()
+    except Exception as e:
+        return {"status": "error", "error": str(e)}, 500
+    return {"status": "ready"}
+
+
+@app.route("/chat", methods=["POST"])
+def chat():
+    session_id = request.json.get("session_id")
+    message = request.json.get("message")
+    if not session_id or not message:
+        return "Missing session_id or message", 400
+
+    chat_handler = service.chat_handler(session_id)
+    if request.json.get("stream", False):
+        return Response(stream_events(chat_handler, message), mimetype="application/x-ndjson")
+    try:
+        output = final_output(asyncio.run_coroutine_threadsafe(chat_handler.asend_message(message),
+                                                               service.loop).result())
+    except Exception:
+        logger.exception("Failed to answer a message")
+        output = FALLBACK_OUTPUT
+    return {"output": output}
+
+
+@app.route("/sessions/<session_id>", methods=["DELETE"])
+def clear_session(session_id):
+    service.clear_history(session_id)
+    return "", 204
+
+
+if AGENT_WARM_UP:
+    threading.Thread(target=service.warm_up, daemon=True).start()
+
+
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", port=8891, threaded=True)
@@ -0,0 +1,120 @@
+import asyncio
+import datetime
+import functools
+import hashlib
+import inspect
+import json
+import threading
+from collections import defaultdict
+
+import redis
+from pydantic import ValidationError
+
+from core.utils import LRUCache
+
+
+def seconds_until_midnight():
+    now = datetime.datetime.now()
+    midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time())
+    return max(int((midnight - now).total_seconds()), 1)
+
+
+TOOL_CACHE_TTLS = {
+    "get_package_info": 60,
+    "calculate_delivery_cost": 6 * 60 * 60,
+    # Delivery estimates depend on today's schedules, so they are only reused within the same day
+    "estimate_delivery_date": seconds_until_midnight,
+}
+
+
+def successful_output(output):
+    # The tools return their results as data and every message for the user (missing arguments, not found,
+    # invalid input) as a string, only the results are worth keeping
+    return output is not None and not isinstance(output, str)
+
+
+def canonical_value(value):
+    if isinstance(value, str):
+        return " ".join(value.lower().split())
+    return value
+
+
+class ToolResponseCache:
+    def __init__(self, redis_client=None, ttls=TOOL_CACHE_TTLS, local_max_size=1024, key_prefix="tool:"):
+        self.redis_client = redis_client
+        self.ttls = ttls
+        self.key_prefix = key_prefix
+        self.local_cache = LRUCache(max_size=local_max_size)
+        self.stats = defaultdict(lambda: {"hits": 0, "misses": 0})
+        self._stats_lock = threading.Lock()
+
+    def ttl(self, tool_name):
+        ttl = self.ttls[tool_name]
+        return ttl() if callable(ttl) else ttl
+
+    def key(self, tool_name, signature, args_schema, args, kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        values = dict(bound.arguments)
+        try:
+            # Let the pydantic model coerce types, so 2, "2" and 2.0 kg share one entry
+            values.update(args_schema(**values).dict())
+        except ValidationError:
+            pass
+        canonical_args = json.dumps({key: canonical_value(value) for key, value in values.items()},
+                                    sort_keys=True, ensure_ascii=False, default=str)
+        return self.key_prefix + tool_name + ":" + hashlib.sha256(canonical_args.encode()).hexdigest()
+
+    def record(self, tool_name, hit):
+        with self._stats_lock:
+            self.stats[tool_name]["hits" if hit else "misses"] += 1
+
+    def get(self, tool_name, key):
+        output = self.local_cache.get(key)
+        if output is None and self.redis_client is not None:
+            try:
+                cached_output = self.redis_client.get(key)
+                ttl = self.redis_client.ttl(key) if cached_output is not None else None
+            except redis.RedisError:
+                cached_output = None
+            if cached_output is not None:
+                output = json.loads(cached_output)
+                self.local_cache.set(key, output, ttl=ttl if ttl and ttl > 0 else self.ttl(tool_name))
+        self.record(tool_name, hit=output is not None)
+        return output
+
+    def set(self, tool_name, key, output):
+        if not successful_output(output):
+            return
+        ttl = self.ttl(tool_name)
+        self.local_cache.set(key, output, ttl=ttl)
+        if self.redis_client is not None:
+            try:
+                self.redis_client.set(key, json.dumps(output, ensure_ascii=False), ex=ttl)
+            except redis.RedisError:
+                pass
+
+    def wrap(self, func, args_schema, tool_name=None):
+        tool_name = tool_name or func.__name__
+        signature = inspect.signature(func)
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def cached_func(*args, **kwargs):
+                key = self.key(tool_name, signature, args_schema, args, kwargs)
+                # Redis calls stay off the event loop
+                output = await asyncio.to_thread(self.get, tool_name, key)
+                if output is None:
+                    output = await func(*args, **kwargs)
+                    await asyncio.to_thread(self.set, tool_name, key, output)
+                return output
+        else:
+            @functools.wraps(func)
+            def cached_func(*args, **kwargs):
+                key = self.key(tool_name, signature, args_schema, args, kwargs)
+                output = self.get(tool_name, key)
+                if output is None:
+                    output = func(*args, **kwargs)
+                    self.set(tool_name, key, output)
+                return output
+        return cached_func
@@ -1,9 +1,18 @@
+import asyncio
 import inspect
-import os
-import requests
 
 from pydantic import BaseModel, Field
 
+from core.city_index import city_index_loader, normalize_city_name
+from core.novaposhta_client import np_client
+from core.utils import LRUCache, SingleFlight
+
+
+CITY_NOT_FOUND = "Місто не знайдено"
+# Resolved through the API when the local index misses, shared by the tools running in one agent step
+city_identifiers = LRUCache(max_size=4096, ttl=24 * 60 * 60)
+city_lookups = SingleFlight()
+
 
 class Invoice(BaseModel):
     item_description: str = Field(
@@ -117,20 +126,27 @@ def get_invoice(item_description, sender_name, reciever_name, sender_phone, reci
     return output
 
 
-def get_package_info(track_number):
-    request_json = {
-        "modelName": "TrackingDocument",
-        "calledMethod": "getStatusDocuments",
-        "methodProperties":
-        {
-            "Documents":
-            [
-                {"DocumentNumber": track_number}
-            ]
-        }
+def missing_args_message(header, schema, values):
+    missings_args = [key for key, value in values.items() if not value]
+    if not missings_args:
+        return
+    message = header
+    for i, key in enumerate(missings_args):
+        desc = schema.__schema_cache__[(True, "#/definitions/{model}")]['properties'][key]['description']
+        message += f"{i+1}. {desc}"
+    return message
+
+
+def package_info_request(tracking_number):
+    return "TrackingDocument", "getStatusDocuments", {
+        "Documents":
+        [
+            {"DocumentNumber": str(tracking_number)}
+        ]
     }
-    response = requests.get(
-        url="https://api.novaposhta.ua/v2.0/json/", json=request_json).json()
+
+
+def package_info_output(response):
     if not response["success"]:
         return "Відправлення не знайдено"
 
@@ -150,6 +166,45 @@ def get_package_info(track_number):
     return output
 
 
+def get_package_info(tracking_number):
+    return package_info_output(np_client.call(*package_info_request(tracking_number)))
+
+
+async def aget_package_info(tracking_number):
+    return package_info_output(await np_client.acall(*package_info_request(tracking_number)))
+
+
+def delivery_cost_missing_args(city_sender, city_recipient, weight, cost, cargo_type, width, length, height):
+    return missing_args_message("Щоб порахувати вартість доставки потрібно надати:\n", DeliveryCost, {
+        "city_sender": city_sender, "city_recipient": city_recipient, "weight": weight, "cost": cost,
+        "cargo_type": cargo_type, "width": width, "length": length, "height": height})
+
+
+def delivery_cost_request(city_sender_identifier, city_recipient_identifier, weight, cost, cargo_type,
+                          width, length, height, service_type):
+    return "InternetDocument", "getDocumentPrice", {
+        "CitySender": city_sender_identifier,
+        "CityRecipient": city_recipient_identifier,
+        "Weight": weight,
+        "ServiceType": service_type,
+        "Cost": str(cost),
+        "CargoType": cargo_type,
+        "SeatsAmount": 1,
+        "OptionsSeat": [{
+            "weight": weight,
+            "volumetricWidth": width,
+            "volumetricLength": length,
+            "volumetricHeight": height, }
+        ]
+    }
+
+
+def delivery_cost_output(response):
+    if not response["success"]:
+        return
+    return response['data'][0]['Cost']
+
+
 def calculate_delivery_cost(city_sender,
                             city_recipient,
                             weight,
@@ -160,91 +215,95 @@ def calculate_delivery_cost(city_sender,
                             height,
                             service_type="WarehouseWarehouse") -> float:
     """Useful for when you need to estimate the delivery cost"""
-    frame = inspect.currentframe()
-    args, _, _, values = inspect.getargvalues(frame)
-    missings_args = [key for key in args if not values[key]]
-    if missings_args:
-        message = "Щоб порахувати вартість доставки потрібно надати:\n"
-        for i, key in enumerate(missings_args):
-            description = DeliveryCost.__schema_cache__[
-                (True, "#/definitions/{model}")]["properties"][key]["description"]
-            message += f"{i+1}. {description}"
+    message = delivery_cost_missing_args(city_sender, city_recipient, weight, cost, cargo_type, width, length, height)
+    if message:
         return message
     city_sender_identifier = get_city_identifier(city_sender)
     city_recipient_identifier = get_city_identifier(city_recipient)
-    request_json = {
-    	"apiKey": os.environ["NOVA_POST_API_KEY"],
-    	"modelName": "InternetDocument",
-    	"calledMethod": "getDocumentPrice",
-    	"methodProperties": {
-    		"CitySender": city_sender_identifier,
-    		"CityRecipient": city_recipient_identifier,
-    		"Weight": weight,
-    		"ServiceType": service_type,
-    		"Cost": str(cost),
-    		"CargoType": cargo_type,
-    		"SeatsAmount": 1,
-            "OptionsSeat": [{
-                    "weight": weight, 
-                    "volumetricWidth": width,
-                    "volumetricLength": length,
-                    "volumetricHeight": height, }
-               ]
-    	}
-    }
-    response = requests.get(url="https://api.novaposhta.ua/v2.0/json/", json=request_json).json()
-    if not response["success"]:
-        return
-    return response['data'][0]['Cost']
+    response = np_client.call(*delivery_cost_request(city_sender_identifier, city_recipient_identifier, weight,
+                                                     cost, cargo_type, width, length, height, service_type))
+    return delivery_cost_output(response)
 
 
+async def acalculate_delivery_cost(city_sender,
+                                   city_recipient,
+                                   weight,
+                                   cost,
+                                   cargo_type,
+                                   width,
+                                   length,
+                                   height,
+                                   service_type="WarehouseWarehouse") -> float:
+    """Useful for when you need to estimate the delivery cost"""
+    message = delivery_cost_missing_args(city_sender, city_recipient, weight, cost, cargo_type, width, length, height)
+    if message:
+        return message
+    city_sender_identifier, city_recipient_identifier = await asyncio.gather(
+        aget_city_identifier(city_sender), aget_city_identifier(city_recipient))
+    response = await np_client.acall(*delivery_cost_request(city_sender_identifier, city_recipient_identifier, weight,
+                                                            cost, cargo_type, width, length, height, service_type))
+    return delivery_cost_output(response)
 
-def get_city_identifier(city_name):
-    request_json = {
-        "apiKey": os.environ["NOVA_POST_API_KEY"],
-        "modelName": "Address",
-        "calledMethod": "searchSettlements",
-        "methodProperties": {
-            "CityName": city_name,
-            "Limit": "1",
-            "Page": "1"
-        }
+
+def city_identifier_request(city_name):
+    return "Address", "searchSettlements", {
+        "CityName": city_name,
+        "Limit": "1",
+        "Page": "1"
     }
-    response = requests.get(
-        url="https://api.novaposhta.ua/v2.0/json/", json=request_json).json()
+
+
+def city_identifier_output(response):
     if not response["success"]:
-        return "Місто не знайдено"
+        return CITY_NOT_FOUND
 
     info = response["data"][0]["Addresses"][0]
     output = info.get("Ref", "")
     return output
 
 
-def estimate_delivery_date(date, city_sender, city_recipient):
-    frame = inspect.currentframe()
-    args, _, _, values = inspect.getargvalues(frame)
-    missings_args = [key for key in args if not values[key]]
-    if missings_args:
-        message = "Щоб оцінити час доставки потрібно надати:\n"
-        for i, key in enumerate(missings_args):
-            desc = DeliveryDetails.__schema_cache__[(True, "#/definitions/{model}")]['properties'][key]['description']
-            message += f"{i+1}. {desc}"
-        return message
+def get_city_identifier(city_name):
+    city_ref = city_index_loader.get().lookup(city_name) or city_identifiers.get(normalize_city_name(city_name))
+    if city_ref:
+        return city_ref
+
+    key = normalize_city_name(city_name)
+    city_ref = city_lookups.do(key, lambda: city_identifier_output(np_client.call(*city_identifier_request(city_name))))
+    if city_ref != CITY_NOT_FOUND:
+        city_identifiers.set(key, city_ref)
+    return city_ref
+
+
+async def aget_city_identifier(city_name):
+    city_ref = city_index_loader.get().lookup(city_name) or city_identifiers.get(normalize_city_name(city_name))
+    if city_ref:
+        return city_ref
 
-    request_json = {
-        "apiKey": os.environ["NOVA_POST_API_KEY"],
-        "modelName": "InternetDocument",
-        "calledMethod": "getDocumentDeliveryDate",
-        "methodProperties": {
-            "DateTime": date,
-            "ServiceType": "WarehouseWarehouse",
-            "CitySender": get_city_identifier(city_sender),
-            "CityRecipient": get_city_identifier(city_recipient),
-        }
+    async def search_city():
+        return city_identifier_output(await np_client.acall(*city_identifier_request(city_name)))
+
+    key = normalize_city_name(city_name)
+    city_ref = await city_lookups.ado(key, search_city)
+    if city_ref != CITY_NOT_FOUND:
+        city_identifiers.set(key, city_ref)
+    return city_ref
+
+
+def delivery_date_missing_args(date, city_sender, city_recipient):
+    return missing_args_message("Щоб оцінити час доставки потрібно надати:\n", DeliveryDetails, {
+        "date": date, "city_sender": city_sender, "city_recipient": city_recipient})
+
+
+def delivery_date_request(date, city_sender_identifier, city_recipient_identifier):
+    return "InternetDocument", "getDocumentDeliveryDate", {
+        "DateTime": date,
+        "ServiceType": "WarehouseWarehouse",
+        "CitySender": city_sender_identifier,
+        "CityRecipient": city_recipient_identifier,
     }
 
-    response = requests.get(
-        url="https://api.novaposhta.ua/v2.0/json/", json=request_json).json()
+
+def delivery_date_output(response):
     if not response["success"]:
         return "Перевірте правильність введення даних"
 
@@ -255,3 +314,24 @@ def estimate_delivery_date(date, city_sender, city_recipient):
     }
 
     return output
+
+
+def estimate_delivery_date(date, city_sender, city_recipient):
+    message = delivery_date_missing_args(date, city_sender, city_recipient)
+    if message:
+        return message
+
+    response = np_client.call(*delivery_date_request(
+        date, get_city_identifier(city_sender), get_city_identifier(city_recipient)))
+    return delivery_date_output(response)
+
+
+async def aestimate_delivery_date(date, city_sender, city_recipient):
+    message = delivery_date_missing_args(date, city_sender, city_recipient)
+    if message:
+        return message
+
+    city_sender_identifier, city_recipient_identifier = await asyncio.gather(
+        aget_city_identifier(city_sender), aget_city_identifier(city_recipient))
+    response = await np_client.acall(*delivery_date_request(date, city_sender_identifier, city_recipient_identifier))
+    return delivery_date_output(response)
@@ -1,5 +1,12 @@
+import asyncio
 import glob
+import hashlib
+import json
 import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
 
 from langchain.vectorstores import Chroma
 from langchain.document_loaders import TextLoader
@@ -7,7 +14,7 @@ from langchain.document_loaders import TextLoader
 
 def load_documents(dirpath):
     documents = []
-    for filepath in glob.glob(os.path.join(dirpath, '*txt')):
+    for filepath in sorted(glob.glob(os.path.join(dirpath, '*txt'))):
         documents.extend(TextLoader(filepath, encoding="utf-8").load())
     return documents
 
@@ -17,11 +24,257 @@ def load_texts(dirpath):
     return [doc.page_content for doc in documents]
 
 
-def create_knowledge_vectordb(dirpath, embedder, chroma_client, chroma_persist_directory):
-    collection_names = []
-    for folder in glob.glob(os.path.join(dirpath, "*")):
+def content_hash(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def document_id(collection_name, filepath):
+    return content_hash(f"{collection_name}/{os.path.basename(filepath)}")
+
+
+def knowledge_base_hash(documents):
+    file_hashes = sorted(f"{os.path.basename(doc.metadata['source'])}:{content_hash(doc.page_content)}"
+                         for doc in documents)
+    return content_hash("\n".join(file_hashes))
+
+
+def load_collection_manifest(collection):
+    records = collection.get(include=["metadatas"])
+    return {doc_id: (metadata or {}).get("content_hash")
+            for doc_id, metadata in zip(records["ids"], records["metadatas"])}
+
+
+def sync_collection(collection, documents, embedder):
+    collection_name = collection.name
+    manifest = load_collection_manifest(collection)
+
+    expected_ids = set()
+    changed_ids, changed_texts, changed_metadatas = [], [], []
+    for document in documents:
+        doc_id = document_id(collection_name, document.metadata["source"])
+        doc_hash = content_hash(document.page_content)
+        expected_ids.add(doc_id)
+        if manifest.get(doc_id) != doc_hash:
+            changed_ids.append(doc_id)
+            changed_texts.append(document.page_content)
+            changed_metadatas.append({**document.metadata, "content_hash": doc_hash})
+
+    # Anything not backed by a current file: removed files and legacy duplicates without stable ids
+    removed_ids = [doc_id for doc_id in manifest if doc_id not in expected_ids]
+    if removed_ids:
+        collection.delete(ids=removed_ids)
+    if changed_ids:
+        collection.upsert(ids=changed_ids, embeddings=embedder.embed_documents(changed_texts),
+                          documents=changed_texts, metadatas=changed_metadatas)
+    return {"upserted": len(changed_ids), "deleted": len(removed_ids)}
+
+
+def versioned_collection_name(collection_name, version=None):
+    return f"{collection_name}_{version}" if version else collection_name
+
+
+def create_knowledge_vectordb(dirpath, embedder, chroma_client, chroma_persist_directory, collection_version=None):
+    collection_stats = {}
+    for folder in sorted(glob.glob(os.path.join(dirpath, "*"))):
         documents = load_documents(folder)
-        db = Chroma.from_documents(documents=documents, embedding=embedder, collection_name=os.path.basename(folder),
-                                   client=chroma_client, persist_directory=chroma_persist_directory)
-        collection_names.append(db._collection.name)
-    return collection_names
+        db = Chroma(embedding_function=embedder,
+                    collection_name=versioned_collection_name(os.path.basename(folder), collection_version),
+                    client=chroma_client, persist_directory=chroma_persist_directory)
+        collection_stats[db._collection.name] = sync_collection(db._collection, documents, embedder)
+    return collection_stats
+
+
+def to_thread_coroutine(func):
+    async def coroutine(*args, **kwargs):
+        return await asyncio.to_thread(func, *args, **kwargs)
+    return coroutine
+
+
+class LRUCache:
+    def __init__(self, max_size=1024, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._items[key]
+                return default
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._items[key] = (value, time.monotonic() + ttl if ttl is not None else None)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            future = self._calls.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self._calls[key] = Future()
+        if not is_leader:
+            return future.result()
+
+        try:
+            result = func()
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    async def ado(self, key, coroutine_func):
+        # asyncio futures belong to one loop, so in-flight calls are only shared within it
+        key = (id(asyncio.get_running_loop()), key)
+        future = self._calls.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await coroutine_func()
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            # Nobody may be waiting on it, which must not produce an "exception never retrieved" warning
+            future.exception()
+            raise
+        finally:
+            del self._calls[key]
+
+
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class RedisSingleFlight:
+    # Followers wait no longer than the leader's LLM call may take (CachedConversationalRQA.llm_timeout)
+    def __init__(self, redis_client, lock_timeout=60, wait_timeout=30, poll_interval=0.1, key_prefix="inflight:"):
+        self.redis_client = redis_client
+        self.lock_timeout = lock_timeout
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.key_prefix = key_prefix
+        self.local = SingleFlight()
+        self._release_lock = redis_client.register_script(RELEASE_LOCK_SCRIPT)
+
+    def acquire(self, key):
+        token = os.urandom(16).hex()
+        if self.redis_client.set(f"{self.key_prefix}{key}", token, nx=True, ex=self.lock_timeout):
+            self.redis_client.delete(f"{self.key_prefix}{key}:result")
+            return token
+
+    def release(self, key, token, result=None, error=None):
+        lock_key = f"{self.key_prefix}{key}"
+        message = json.dumps({"error": str(error)} if error is not None else {"result": result}, ensure_ascii=False)
+        # Kept for a while for the async followers, which poll instead of holding a subscription
+        self.redis_client.set(f"{lock_key}:result", message, ex=self.wait_timeout)
+        self.redis_client.publish(lock_key, message)
+        self._release_lock(keys=[lock_key], args=[token])
+
+    def wait(self, key, lookup):
+        lock_key = f"{self.key_prefix}{key}"
+        pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(lock_key)
+            # The leader may have finished before the subscription, then its result is already in the cache
+            if not self.redis_client.exists(lock_key):
+                return lookup()
+            deadline = time.monotonic() + self.wait_timeout
+            while (remaining := deadline - time.monotonic()) > 0:
+                message = pubsub.get_message(timeout=min(remaining, 1.0))
+                if message is not None:
+                    return json.loads(message["data"]).get("result")
+                if not self.redis_client.exists(lock_key):
+                    return lookup()
+        finally:
+            pubsub.close()
+
+    def poll(self, key):
+        lock_key = f"{self.key_prefix}{key}"
+        pipeline = self.redis_client.pipeline()
+        pipeline.get(f"{lock_key}:result")
+        pipeline.exists(lock_key)
+        return pipeline.execute()
+
+    async def await_result(self, key, lookup):
+        # Short Redis calls between sleeps, so a spike of followers does not hold the default executor's threads
+        deadline = time.monotonic() + self.wait_timeout
+        while time.monotonic() < deadline:
+            message, locked = await asyncio.to_thread(self.poll, key)
+            if message is not None:
+                return json.loads(message).get("result")
+            if not locked:
+                return await asyncio.to_thread(lookup)
+            await asyncio.sleep(self.poll_interval)
+
+    def _do(self, key, func, lookup):
+        token = self.acquire(key)
+        if token is None:
+            # Another replica is answering; its failure or a timeout falls back to answering here
+            result = self.wait(key, lookup)
+            if result is not None:
+                return result
+            return func()
+
+        try:
+            result = func()
+        except Exception as e:
+            self.release(key, token, error=e)
+            raise
+        self.release(key, token, result=result)
+        return result
+
+    def do(self, key, func, lookup):
+        return self.local.do(key, lambda: self._do(key, func, lookup))
+
+    async def _ado(self, key, coroutine_func, lookup):
+        token = await asyncio.to_thread(self.acquire, key)
+        if token is None:
+            result = await self.await_result(key, lookup)
+            if result is not None:
+                return result
+            return await coroutine_func()
+
+        try:
+            result = await coroutine_func()
+        except Exception as e:
+            await asyncio.to_thread(self.release, key, token, error=e)
+            raise
+        await asyncio.to_thread(self.release, key, token, result=result)
+        return result
+
+    async def ado(self, key, coroutine_func, lookup):
+        return await self.local.ado(key, lambda: self._ado(key, coroutine_func, lookup))
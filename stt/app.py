@@ -1,41 +1,205 @@
 from flask import Flask, request
-import wave
-import uuid
-import nemo.collections.asr as nemo_asr
+import io
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 
-app = Flask(__name__)
-app.config["UPLOAD_FOLDER"] = "audio"
+import librosa
+import numpy as np
 
+app = Flask(__name__)
 
-models = {
-    "en": nemo_asr.models.ASRModel.restore_from(
-        "models/stt_en_fastconformer_transducer_large.nemo"
-    ),
-    "uk": nemo_asr.models.ASRModel.restore_from(
-        "models/stt_uk_squeezeformer_ctc_ml.nemo"
-    ),
+MODEL_PATHS = {
+    "en": "models/stt_en_fastconformer_transducer_large.nemo",
+    "uk": "models/stt_uk_squeezeformer_ctc_ml.nemo",
 }
+SAMPLE_RATE = 16000
+
+# Every worker holds its own copy of both NeMo models
+NUM_WORKERS = int(os.environ.get("STT_WORKERS", 1))
+QUEUE_SIZE = int(os.environ.get("STT_QUEUE_SIZE", 64))
+MAX_BATCH_SIZE = int(os.environ.get("STT_MAX_BATCH_SIZE", 8))
+MAX_BATCH_WAIT = float(os.environ.get("STT_MAX_BATCH_WAIT", 0.05))
+REQUEST_TIMEOUT = float(os.environ.get("STT_REQUEST_TIMEOUT", 30))
+
+models = {}
+ready = threading.Event()
+
+logger = logging.getLogger(__name__)
+
+
+def init_worker(num_threads):
+    import torch
+    import nemo.collections.asr as nemo_asr
+
+    # Split the cores between the workers instead of every worker fighting over all of them
+    torch.set_num_threads(num_threads)
+    for language, model_path in MODEL_PATHS.items():
+        models[language] = nemo_asr.models.ASRModel.restore_from(model_path)
+        models[language].eval()
+
+
+def transcribe(audios, language):
+    transcriptions = models[language].transcribe(audios, batch_size=len(audios), verbose=False)
+    # Transducer models return (best_hypotheses, all_hypotheses)
+    if isinstance(transcriptions, tuple):
+        transcriptions = transcriptions[0]
+    return [getattr(transcription, "text", transcription) for transcription in transcriptions]
+
+
+def warm_up_worker(barrier):
+    silence = np.zeros(SAMPLE_RATE, dtype=np.float32)
+    for language in MODEL_PATHS:
+        transcribe([silence], language)
+    # Every warm-up task waits for the others, so each of them runs in a different worker
+    barrier.wait()
+
+
+class WorkerPool:
+    # A worker killed mid-transcription (usually out of memory) breaks the whole ProcessPoolExecutor,
+    # so the pool is replaced and warmed up again instead of failing every later request
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.executor = None
+        self.restart()
+
+    def restart(self, broken_executor=None):
+        with self._lock:
+            if broken_executor is not None and self.executor is not broken_executor:
+                return
+            ready.clear()
+            self.executor = ProcessPoolExecutor(max_workers=NUM_WORKERS, initializer=init_worker,
+                                                initargs=(max((os.cpu_count() or 1) // NUM_WORKERS, 1),))
+            threading.Thread(target=self.warm_up, args=(self.executor,), daemon=True).start()
+        if broken_executor is not None:
+            logger.error("A transcription worker died, the worker pool was restarted")
+            broken_executor.shutdown(wait=False)
+
+    def warm_up(self, executor):
+        # The workers load the models in their initializer, so they are started and run once before the app is ready
+        try:
+            with multiprocessing.Manager() as manager:
+                barrier = manager.Barrier(NUM_WORKERS)
+                for future in [executor.submit(warm_up_worker, barrier) for _ in range(NUM_WORKERS)]:
+                    future.result()
+        except Exception:
+            logger.exception("Failed to warm up the transcription workers")
+            return
+        with self._lock:
+            # A pool replaced during its warm-up must not mark the new one as ready
+            if executor is self.executor:
+                ready.set()
+
+    def submit(self, func, *args):
+        executor = self.executor
+        try:
+            return executor, executor.submit(func, *args)
+        except (BrokenProcessPool, RuntimeError):
+            self.restart(executor)
+            raise
+
+
+def decode_audio(audio_bytes):
+    audio, _ = librosa.load(io.BytesIO(audio_bytes), sr=SAMPLE_RATE, mono=True)
+    return audio
+
+
+class MicroBatcher:
+    def __init__(self, pool, language):
+        self.pool = pool
+        self.language = language
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, audio):
+        future = Future()
+        self.queue.put_nowait((audio, future))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + MAX_BATCH_WAIT
+            while len(batch) < MAX_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            audios, futures = zip(*batch)
+            try:
+                executor, batch_future = self.pool.submit(transcribe, list(audios), self.language)
+            except Exception as e:
+                self.fail(futures, e)
+                continue
+            batch_future.add_done_callback(
+                lambda done, executor=executor, futures=futures: self.resolve(done, executor, futures))
+
+    @staticmethod
+    def fail(futures, error):
+        for future in futures:
+            future.set_exception(error)
+
+    def resolve(self, batch_future, executor, futures):
+        if batch_future.exception() is not None:
+            if isinstance(batch_future.exception(), BrokenProcessPool):
+                self.pool.restart(executor)
+            self.fail(futures, batch_future.exception())
+            return
+        for future, transcription in zip(futures, batch_future.result()):
+            future.set_result(transcription)
+
+
+pool = WorkerPool()
+batchers = {language: MicroBatcher(pool, language) for language in MODEL_PATHS}
+
+
+@app.route("/health", methods=["GET"])
+def health():
+    if ready.is_set():
+        return {"status": "ready"}
+    return {"status": "starting"}, 503
 
 
 @app.route("/transcribe", methods=["POST"])
 def api():
     language = request.args.to_dict().get("language", "uk")
-    if language not in models:
+    if language not in batchers:
         return "Unsupported language", 400
 
-    if request.method == "POST":
-        f = request.files["file"]
-        filename = uuid.uuid4().hex + ".wav"
-        f.save(filename)
-        transcription = transcribe(filename, language)
+    if "file" not in request.files:
+        return "Missing file", 400
+
+    if not ready.is_set():
+        return "Models are loading", 503
+
+    try:
+        audio = decode_audio(request.files["file"].read())
+    except Exception:
+        return "Invalid audio", 400
 
-        return {"transcription": transcription}, 200
+    try:
+        future = batchers[language].submit(audio)
+    except queue.Full:
+        return "Too many requests", 503
 
+    try:
+        transcription = future.result(timeout=REQUEST_TIMEOUT)
+    except FutureTimeoutError:
+        return "Transcription timed out", 504
+    except BrokenProcessPool:
+        return "Transcription worker restarting", 503
 
-def transcribe(file_path, language):
-    transcriptions_ua = models[language].transcribe([file_path])
-    return transcriptions_ua[0]
+    return {"transcription": transcription}, 200
 
 
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0", port=8890)
+    app.run(host="0.0.0.0", port=8890, threaded=True)
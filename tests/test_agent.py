@@ -0,0 +1,73 @@
+import asyncio
+import json
+from typing import Any, List
+
+from langchain.chat_models import ChatOpenAI
+from langchain.schema import AIMessage, ChatGeneration, ChatResult
+
+from core.agent import init_agent
+from core.llm_wrapers import ParallelAgentExecutor
+from core.tool_cache import ToolResponseCache
+
+
+class ScriptedChatModel(ChatOpenAI):
+    # The functions agents accept only ChatOpenAI, the requests never leave the process
+    responses: List[Any]
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return ChatResult(generations=[ChatGeneration(message=self.responses.pop(0))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        return self._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+
+class StaticRQA:
+    def __init__(self, answer):
+        self.answer = answer
+        self.questions = []
+
+    def __call__(self, question, chat_messages):
+        self.questions.append(question)
+        return self.answer
+
+    async def acall(self, question, chat_messages):
+        return self(question, chat_messages)
+
+
+def tool_selection(*actions):
+    arguments = {"actions": [{"action_name": name, "action": action} for name, action in actions]}
+    return AIMessage(content="", additional_kwargs={"function_call": {"name": "tool_selection",
+                                                                      "arguments": json.dumps(arguments)}})
+
+
+def build_agent(responses, answer="Відповідь з бази знань"):
+    rqa = StaticRQA(answer)
+    llm = ScriptedChatModel(responses=responses, openai_api_key="test")
+    return init_agent(rqa, llm, ToolResponseCache()), llm, rqa
+
+
+def test_init_agent_builds_parallel_executor():
+    agent, _, _ = build_agent([])
+    assert isinstance(agent, ParallelAgentExecutor)
+    assert not any(tool.return_direct for tool in agent.tools)
+
+
+def test_question_answering_returns_directly():
+    agent, llm, rqa = build_agent([tool_selection(("question_answering", {"question": "Як відправити посилку?"}))])
+    output = agent.run({"input": "Як відправити посилку?", "chat_messages": ""})
+    assert output == "Відповідь з бази знань"
+    assert rqa.questions == ["Як відправити посилку?"]
+    # The tool output is the answer, the agent makes no second LLM call
+    assert llm.responses == []
+
+
+def test_question_answering_returns_directly_async():
+    agent, llm, _ = build_agent([tool_selection(("question_answering", {"question": "Як відправити посилку?"}))])
+    output = asyncio.run(agent.arun({"input": "Як відправити посилку?", "chat_messages": ""}))
+    assert output == "Відповідь з бази знань"
+    assert llm.responses == []
+
+
+def test_direct_answer_without_tools():
+    agent, _, _ = build_agent([AIMessage(content="Привіт!")])
+    assert agent.run({"input": "Привіт", "chat_messages": ""}) == "Привіт!"
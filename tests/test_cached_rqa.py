@@ -0,0 +1,62 @@
+import asyncio
+from types import SimpleNamespace
+
+from langchain.schema import Document
+
+from core.llm_wrapers import CachedConversationalRQA
+
+
+class DictCache:
+    def __init__(self):
+        self.completions = {}
+
+    def key(self, prompt):
+        return prompt
+
+    def get(self, prompt):
+        return self.completions.get(prompt)
+
+    async def aget(self, prompt):
+        return self.get(prompt)
+
+    def set(self, prompt, completion):
+        self.completions[prompt] = completion
+
+    async def aset(self, prompt, completion):
+        self.set(prompt, completion)
+
+
+class StaticRetriever:
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def aget_relevant_documents(self, query):
+        return self.docs
+
+
+class StaticCombineChain:
+    async def arun(self, input_documents, question, callbacks=None):
+        return "Відповідь" if input_documents else "Зверніться до служби підтримки"
+
+
+def build_rqa(docs):
+    def rqa_chain(question, callbacks=None):
+        return {"result": "Відповідь" if docs else "Зверніться до служби підтримки", "source_documents": docs}
+
+    rqa_chain.retriever = StaticRetriever(docs)
+    rqa_chain.combine_documents_chain = StaticCombineChain()
+    cache = DictCache()
+    return CachedConversationalRQA(None, rqa_chain, cache), cache
+
+
+def test_answer_with_context_is_cached():
+    rqa, cache = build_rqa([Document(page_content="Контекст")])
+    assert asyncio.run(rqa.acall("Питання", [])) == "Відповідь"
+    assert cache.completions == {"Питання": "Відповідь"}
+
+
+def test_answer_without_context_is_not_cached():
+    rqa, cache = build_rqa([])
+    assert asyncio.run(rqa.acall("Питання", [])) == "Зверніться до служби підтримки"
+    assert rqa("Питання", []) == "Зверніться до служби підтримки"
+    assert cache.completions == {}
@@ -0,0 +1,49 @@
+import os
+import re
+
+import numpy as np
+from rank_bm25 import BM25Okapi
+
+from core.agent import HYBRID_RETRIEVER_SETTINGS, KNOWLEDGE_BASE_DIR
+from core.hybrid_retriever import HybridCollection, HybridRetriever
+from core.utils import load_documents
+
+
+def tokenize(text):
+    return re.findall(r"\w+", text.lower())
+
+
+class OneHotEmbeddings:
+    # Every document of the knowledge base gets its own axis, other texts the last one
+    def __init__(self, docs):
+        self.axes = {doc.page_content.splitlines()[0]: i for i, doc in enumerate(docs)}
+        self.size = len(docs) + 1
+
+    def embed_query(self, text):
+        vector = np.zeros(self.size, dtype=np.float32)
+        vector[self.axes.get(text, self.size - 1)] = 1.0
+        return vector
+
+
+def build_retriever():
+    settings = HYBRID_RETRIEVER_SETTINGS["info"]
+    docs = load_documents(os.path.join(KNOWLEDGE_BASE_DIR, "info"))
+    embedder = OneHotEmbeddings(docs)
+    matrix = np.eye(len(docs), embedder.size, dtype=np.float32)
+    collection = HybridCollection("info", docs, bm25=BM25Okapi([tokenize(doc.page_content) for doc in docs]),
+                                  matrix=matrix, weights=settings["weights"],
+                                  score_threshold=settings["score_threshold"], k=settings["k"])
+    return HybridRetriever(collections=[collection], embedder=embedder, lemmatizer=tokenize), docs
+
+
+def test_knowledge_base_question_is_retrieved():
+    retriever, docs = build_retriever()
+    question = docs[0].page_content.splitlines()[0]
+    assert retriever.get_relevant_documents(question)[0] == docs[0]
+
+
+def test_unrelated_query_returns_nothing():
+    retriever, _ = build_retriever()
+    # Shares common words with the knowledge base, but is about nothing in it
+    for query in ["Яка погода завтра у Києві?", "Розкажи анекдот про котів", "What is the capital of France?"]:
+        assert retriever.get_relevant_documents(query) == []
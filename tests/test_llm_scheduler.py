@@ -0,0 +1,55 @@
+import asyncio
+import time
+
+import fakeredis
+
+from core.llm_scheduler import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, LLMScheduler
+
+
+def test_interactive_calls_go_first_and_flows_are_fair():
+    async def run():
+        scheduler = LLMScheduler(max_concurrency=1)
+        permit = await scheduler.aacquire(10, PRIORITY_INTERACTIVE, "a")
+        order = []
+
+        async def call(name, priority, flow):
+            call_permit = await scheduler.aacquire(10, priority, flow)
+            order.append(name)
+            scheduler.release(call_permit, 10)
+
+        tasks = [asyncio.create_task(call(*args)) for args in [("warm-up", PRIORITY_BACKGROUND, "warmer"),
+                                                             ("a2", PRIORITY_INTERACTIVE, "a"),
+                                                             ("b1", PRIORITY_INTERACTIVE, "b")]]
+        await asyncio.sleep(0.01)
+        scheduler.release(permit, 10)
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(run()) == ["b1", "a2", "warm-up"]
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def run():
+        scheduler = LLMScheduler(max_concurrency=1)
+        permit = await scheduler.aacquire(10)
+        cancelled = asyncio.create_task(scheduler.aacquire(10))
+        waiting = asyncio.create_task(scheduler.aacquire(10))
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        scheduler.release(permit)
+        scheduler.release(await asyncio.wait_for(waiting, 1))
+        return scheduler
+
+    scheduler = asyncio.run(run())
+    assert scheduler.in_flight == 0 and scheduler._queue == [] and scheduler._reserving is None
+
+
+def test_processes_share_the_redis_budget():
+    redis_client = fakeredis.FakeRedis()
+    # Two schedulers stand for two processes with the same account limits
+    first = LLMScheduler(tokens_per_minute=60, redis_client=redis_client)
+    second = LLMScheduler(tokens_per_minute=60, redis_client=redis_client)
+    first.release(first.acquire(60))
+    started_at = time.monotonic()
+    second.release(second.acquire(1))
+    assert time.monotonic() - started_at >= 0.9
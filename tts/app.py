@@ -1,15 +1,52 @@
-from flask import Flask, request, send_file
-import wave
-import uuid
+from flask import Flask, request, Response
+import hashlib
+import os
+import re
+import struct
+import threading
+from collections import OrderedDict
 from balacoon_tts import TTS
 
 app = Flask(__name__)
 
+CACHE_MAX_BYTES = int(os.environ.get("TTS_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?…])\s+|\n+")
+
 
 models = {
     "en": TTS("models/en_us_cmuartic_jets_cpu.addon"),
     "uk": TTS("models/uk_ltm_jets_cpu.addon"),
 }
+speakers = {language: tts.get_speakers()[-1] for language, tts in models.items()}
+model_locks = {language: threading.Lock() for language in models}
+
+
+class AudioCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            samples = self._items.get(key)
+            if samples is not None:
+                self._items.move_to_end(key)
+            return samples
+
+    def set(self, key, samples):
+        with self._lock:
+            if key in self._items:
+                return
+            self._items[key] = samples
+            self.size += len(samples)
+            while self.size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+
+audio_cache = AudioCache(CACHE_MAX_BYTES)
 
 
 @app.route("/synthesize", methods=["POST"])
@@ -23,22 +60,42 @@ def api():
 
     text = request.json.get("text")
 
-    filename = synthesize(text, language)
-    return send_file(f"audio/{filename}", mimetype="audio/wav")
+    return Response(stream_wav(text, language), mimetype="audio/wav")
+
+
+def normalize_text(text):
+    return " ".join(text.split())
+
+
+def split_sentences(text):
+    return [sentence for sentence in SENTENCE_BOUNDARY.split(normalize_text(text)) if sentence]
+
+
+def wav_header(sampling_rate, channels=1, sample_width=2):
+    # The total length is unknown while streaming, so the sizes are set to the maximum as players expect
+    unknown_size = 0xFFFFFFFF
+    return (b"RIFF" + struct.pack("<I", unknown_size) + b"WAVE"
+            + b"fmt " + struct.pack("<IHHIIHH", 16, 1, channels, sampling_rate,
+                                    sampling_rate * channels * sample_width, channels * sample_width, sample_width * 8)
+            + b"data" + struct.pack("<I", unknown_size))
 
 
 def synthesize(text, language):
-    id = uuid.uuid4().hex
+    speaker = speakers[language]
+    key = hashlib.sha256(f"{language}\0{speaker}\0{text}".encode()).hexdigest()
+    samples = audio_cache.get(key)
+    if samples is None:
+        with model_locks[language]:
+            samples = models[language].synthesize(text, speaker).tobytes()
+        audio_cache.set(key, samples)
+    return samples
 
-    tts = models[language]
-    supported_speakers = tts.get_speakers()
-    samples = tts.synthesize(text, supported_speakers[-1])
 
-    with wave.open(f"audio/{id}.wav", "w") as fp:
-        fp.setparams((1, 2, tts.get_sampling_rate(), len(samples), "NONE", "NONE"))
-        fp.writeframes(samples)
-    return f"{id}.wav"
+def stream_wav(text, language):
+    yield wav_header(models[language].get_sampling_rate())
+    for sentence in split_sentences(text):
+        yield synthesize(sentence, language)
 
 
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0", port=8889)
+    app.run(host="0.0.0.0", port=8889, threaded=True)
@@ -1,28 +1,77 @@
+import io
+import json
+import os
+import wave
+
 import requests
 from pydub import AudioSegment
+from requests.adapters import HTTPAdapter
 
 TTS_SERVER = "http://tts.local:8889/synthesize"
 STT_SERVER = "http://stt.local:8890/transcribe"
+AGENT_SERVER = os.environ.get("AGENT_SERVER", "http://agent.local:8891")
 
-def tts(text_to_voice, language):
-    response = requests.post(
+# (connect, read) seconds
+TTS_TIMEOUT = (2, 30)
+STT_TIMEOUT = (2, 60)
+AGENT_TIMEOUT = (2, 120)
+
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_maxsize=20))
+
+
+def tts_stream(text_to_voice, language, chunk_size=16384):
+    with session.post(
         TTS_SERVER,
         json={"text": text_to_voice, "language": language},
         stream=True,
-    )
-    return response.raw.read()
+        timeout=TTS_TIMEOUT,
+    ) as response:
+        response.raise_for_status()
+        yield from response.iter_content(chunk_size=chunk_size)
 
 
-def stt(audio_bytes, language):
-    with open("track.wav", "wb") as fp:
-        fp.write(audio_bytes)
+def tts(text_to_voice, language):
+    return b"".join(tts_stream(text_to_voice, language))
+
 
-    sound = AudioSegment.from_wav("track.wav")
-    sound = sound.set_channels(1)
-    sound.export("mono_track.wav", format="wav")
+def to_mono_wav(audio_bytes):
+    try:
+        with wave.open(io.BytesIO(audio_bytes)) as wav:
+            if wav.getnchannels() == 1:
+                return audio_bytes
+    except (wave.Error, EOFError):
+        # Not a PCM WAV the wave module can read (float samples, compressed audio), ffmpeg converts it below
+        pass
 
-    response = requests.post(
-        f"{STT_SERVER}?language={language}",
-        files={"file": open("mono_track.wav", "rb")},
+    mono_track = io.BytesIO()
+    AudioSegment.from_file(io.BytesIO(audio_bytes)).set_channels(1).export(mono_track, format="wav")
+    return mono_track.getvalue()
+
+
+def stt(audio_bytes, language):
+    response = session.post(
+        STT_SERVER,
+        params={"language": language},
+        files={"file": ("track.wav", to_mono_wav(audio_bytes), "audio/wav")},
+        timeout=STT_TIMEOUT,
     )
+    response.raise_for_status()
     return response.json()["transcription"]
+
+
+def chat_stream(session_id, message):
+    with session.post(
+        f"{AGENT_SERVER}/chat",
+        json={"session_id": session_id, "message": message, "stream": True},
+        stream=True,
+        timeout=AGENT_TIMEOUT,
+    ) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line:
+                yield json.loads(line)
+
+
+def clear_chat(session_id):
+    session.delete(f"{AGENT_SERVER}/sessions/{session_id}", timeout=AGENT_TIMEOUT).raise_for_status()